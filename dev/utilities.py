@@ -479,6 +479,8 @@ def install_deps():
     # computer vision deps
     _run_sudo("apt install -y python3-picamera2 --no-install-recommends")
     _run_sudo("apt install -y python3-opencv opencv-data")
+    # native kernels, see src/Makefile
+    _run_sudo("apt install -y g++ python3-dev python3-pybind11")
 
     _run_sudo("pip install -r /build/requirements.txt")
     _run_sudo("npm --prefix /build/gui install /build/gui")
@@ -537,7 +539,8 @@ def build():
     except FileExistsError:
         pass
     _copydir("src", "build")
-    #os.system("make build")
+    # native kernels are compiled on the board when the service starts,
+    # a module built here would not load on its architecture
 
 
 def clone():
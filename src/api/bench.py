@@ -0,0 +1,300 @@
+"""Headless benchmark for process_frame.
+
+Run from the src directory:
+
+    python -m api.bench --resolutions 1536x160,768x80 --cut-heights 20,40,80 --threads 1,2,4
+    python -m api.bench --pixel-formats jpeg,rgb,yuv420
+    python -m api.bench --previews none
+    python -m api.bench --classifiers hsv,lut,native --check
+    python -m api.bench --bands '{"far": [0.35, 24], "near": [0.7, 40]}'
+    python -m api.bench --dataset replay:/path/to/frames --output bench.json --compare old.json
+    python -m api.bench --dataset recording:recording.frt --recorder /tmp/bench.frt
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from api.config import Config, parse_bands
+from api.sources import SyntheticSource, ReplaySource, RecordingSource, encode_frame
+from api.vision import process_frame, read_strip, hsv_masks, lut_masks, rendition, default_renditions, preview_changes
+from api.classify import table, find_blobs, native, native_blobs
+from api.timing import timer
+from api.tracking import trackers
+from api.recorder import recorder
+
+
+def _parse_list(value, kind = int):
+    return [kind(item) for item in value.split(',') if item.strip() != ""]
+
+
+def _parse_resolution(value):
+    width, height = value.lower().split('x')
+    return (int(width), int(height))
+
+
+def _parse_previews(value):
+    if value == "all":
+        return default_renditions()
+    if value == "none":
+        return ()
+    return tuple(rendition(name) for name in _parse_list(value, str))
+
+
+def load_dataset(spec, count):
+    """Returns `count` frames at Config.full_resolution in Config.pixel_format."""
+    kind, _, arg = spec.partition(':')
+    if kind == "synthetic":
+        source = SyntheticSource(cycle = count)
+        return [source.read() for _ in range(count)]
+
+    if kind == "replay":
+        source = ReplaySource(arg)
+        frames = []
+        for buf in source.frames:
+            # rescale recordings so the resolution sweep stays meaningful
+            image = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if (image.shape[1], image.shape[0]) != Config.full_resolution:
+                image = cv2.resize(image, Config.full_resolution, interpolation = cv2.INTER_AREA)
+            frames.append(encode_frame(image))
+        return list(itertools.islice(itertools.cycle(frames), count))
+
+    if kind == "recording":
+        # recorded as the pipeline saw them, not rescaled
+        return list(itertools.islice(itertools.cycle(RecordingSource(arg).frames), count))
+
+    raise ValueError(f"Unknown dataset \"{spec}\"")
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p90_ms": round(float(np.percentile(samples, 90)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "max_ms": round(float(samples.max()), 3),
+    }
+
+
+def measure_allocations(frames, previews):
+    # tracemalloc slows everything down, so it gets its own pass
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    for buf in frames:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        process_frame(buf, previews)
+        after, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(after - before)
+    tracemalloc.stop()
+    return {
+        "peak_bytes_per_frame": int(np.mean(peaks)),
+        "retained_bytes_per_frame": int(np.mean(retained)),
+    }
+
+
+def check_parity(frames):
+    """Compares the lookup table masks against the HSV reference masks.
+
+    When the native kernel is built, its blobs are also compared against
+    the blobs of the lut path, which they have to match exactly.
+    """
+    mismatch = collections.defaultdict(list)
+    iou = collections.defaultdict(list)
+    native_mismatch = collections.defaultdict(int)
+    names = tuple(Config.color_ranges)
+    for buf in frames:
+        frame, section, top = read_strip(buf)
+        _, reference = hsv_masks(section, Config.color_ranges)
+        _, masks = lut_masks(section, Config.color_ranges)
+        for name in reference:
+            expected = reference[name] != 0
+            actual = masks[name] != 0
+            mismatch[name].append(np.count_nonzero(expected != actual) / expected.size)
+            union = np.count_nonzero(expected | actual)
+            if union > 0:
+                iou[name].append(np.count_nonzero(expected & actual) / union)
+
+        if native is not None:
+            expected = find_blobs(table.classify(section), names)
+            actual = native_blobs(section, names)
+            for name in names:
+                if expected.get(name) != actual.get(name):
+                    native_mismatch[name] += 1
+
+    return {
+        name: {
+            "mismatch": round(float(np.mean(mismatch[name])), 5),
+            "iou": round(float(np.mean(iou[name])), 4) if len(iou[name]) > 0 else None,
+            "native_mismatch": native_mismatch[name] if native is not None else None,
+        }
+        for name in mismatch
+    }
+
+
+def run_case(dataset, frames, warmup, allocation_frames, previews):
+    data = load_dataset(dataset, frames)
+
+    for buf in data[:warmup]:
+        process_frame(buf, previews)
+
+    timer.reset()
+    trackers.reset()
+    preview_changes.reset()
+    latencies = np.empty(len(data))
+    start = time.perf_counter()
+    for i, buf in enumerate(data):
+        frame_start = time.perf_counter()
+        process_frame(buf, previews, i + 1, frame_start)
+        latencies[i] = time.perf_counter() - frame_start
+    total = time.perf_counter() - start
+
+    result = {
+        "fps": round(len(data) / total, 2),
+        "latency": percentiles(latencies),
+        "stages": timer.summary(),
+        "tracking": trackers.stats(),
+        "previews": preview_changes.stats(),
+    }
+    if allocation_frames > 0:
+        result["allocations"] = measure_allocations(data[:allocation_frames], previews)
+    return result
+
+
+def run(args):
+    results = []
+    cases = itertools.product(args.classifiers, args.pixel_formats, args.resolutions, args.cut_heights, args.threads)
+    for classifier, pixel_format, resolution, cut_frame_height, threads in cases:
+        Config.classifier = classifier
+        Config.pixel_format = pixel_format
+        Config.full_resolution = resolution
+        Config.cut_frame_height = cut_frame_height
+        Config.opencv_threads = threads
+        cv2.setNumThreads(threads)
+
+        result = run_case(args.dataset, args.frames, args.warmup, args.allocation_frames, args.previews)
+        result["params"] = {
+            "previews": sorted(preview.name for preview in args.previews),
+            "classifier": classifier,
+            "tracking": args.tracking,
+            "preview_keyframe": Config.preview_keyframe,
+            "recorder": args.recorder is not None,
+            "bands": Config.bands,
+            "pixel_format": pixel_format,
+            "full_resolution": list(resolution),
+            "cut_frame_height": cut_frame_height,
+            "opencv_threads": threads,
+        }
+        if args.check:
+            result["parity"] = check_parity(load_dataset(args.dataset, args.frames))
+            for name, parity in result["parity"].items():
+                verdict = "ok" if parity["mismatch"] <= args.tolerance else "MISMATCH"
+                print("    %-8s lut vs hsv: %.3f%% pixels differ, iou %s  %s" % (name, parity["mismatch"] * 100, parity["iou"], verdict))
+                if parity["native_mismatch"] is not None:
+                    verdict = "ok" if parity["native_mismatch"] == 0 else "MISMATCH"
+                    print("    %-8s native vs lut: %d frames with different blobs  %s" % (name, parity["native_mismatch"], verdict))
+        results.append(result)
+
+        print(
+            "%-4s %-6s %5dx%-4d cut %-4d threads %-2d  %8.2f fps  p50 %7.3f ms  p95 %7.3f ms  p99 %7.3f ms" % (
+                classifier, pixel_format, resolution[0], resolution[1], cut_frame_height, threads, result["fps"],
+                result["latency"]["p50_ms"], result["latency"]["p95_ms"], result["latency"]["p99_ms"],
+            ),
+            flush = True
+        )
+
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec = "seconds"),
+            "host": platform.node(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "dataset": args.dataset,
+            "frames": args.frames,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    def key(result):
+        params = result["params"]
+        return tuple(json.dumps(params[name], sort_keys = True) for name in sorted(params))
+
+    old = {key(result): result for result in baseline["results"]}
+    print("\nCompared to baseline from %s (%s):" % (baseline["meta"]["date"], baseline["meta"]["host"]))
+    for result in report["results"]:
+        previous = old.get(key(result))
+        if previous is None:
+            continue
+        change = (result["fps"] / previous["fps"] - 1) * 100
+        print("    %s  %8.2f -> %8.2f fps (%+.1f%%)" % (result["params"], previous["fps"], result["fps"], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark process_frame without the camera.")
+    parser.add_argument("--dataset", default = "synthetic", help = "synthetic, replay:/path/to/frames or recording:/path/to/recording.frt")
+    parser.add_argument("--frames", type = int, default = 300)
+    parser.add_argument("--warmup", type = int, default = 20)
+    parser.add_argument("--allocation-frames", type = int, default = 30, help = "frames traced for allocations, 0 disables")
+    parser.add_argument("--resolutions", type = lambda v: _parse_list(v, _parse_resolution), default = [Config.full_resolution])
+    parser.add_argument("--cut-heights", type = _parse_list, default = [Config.cut_frame_height])
+    parser.add_argument("--threads", type = _parse_list, default = [Config.opencv_threads])
+    parser.add_argument("--pixel-formats", type = lambda v: _parse_list(v, str), default = [Config.pixel_format], help = "jpeg, rgb, yuv420")
+    parser.add_argument("--classifiers", type = lambda v: _parse_list(v, str), default = [Config.classifier], help = "hsv, lut, native")
+    parser.add_argument("--tracking", action = "store_true", help = "search around the last detections, see api/tracking.py")
+    parser.add_argument("--check", action = "store_true", help = "compare the lut masks against the hsv masks and the native blobs against the lut blobs")
+    parser.add_argument("--tolerance", type = float, default = 0.01, help = "largest fraction of differing mask pixels accepted by --check")
+    parser.add_argument("--previews", type = _parse_previews, default = "all", help = "previews to render: all, none or a comma separated list")
+    parser.add_argument("--preview-keyframe", type = int, default = Config.preview_keyframe, help = "frames between two forced preview encodes, 0 encodes every preview every frame")
+    parser.add_argument("--output", help = "write the results as JSON")
+    parser.add_argument("--compare", help = "JSON results of an earlier run")
+    parser.add_argument("--bands", type = parse_bands, help = "bands as in FRT_BANDS, searched in every frame")
+    parser.add_argument("--recorder", help = "run the flight recorder into this file while measuring")
+    parser.add_argument("--no-stage-timing", action = "store_true", help = "measure with the stage timers switched off")
+    args = parser.parse_args()
+
+    timer.enabled = not args.no_stage_timing
+    Config.tracking = args.tracking
+    Config.preview_keyframe = args.preview_keyframe
+    if args.bands:
+        Config.bands = args.bands
+    if args.recorder:
+        recorder.open(args.recorder)
+
+    report = run(args)
+    recorder.close()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent = 4)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+
+    if args.check:
+        for result in report["results"]:
+            if any(parity["mismatch"] > args.tolerance or parity["native_mismatch"] for parity in result["parity"].values()):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import json
+import os
+
+
+class Config:
+    cut_frame_height = 40
+    full_resolution = (1536, 160)
+    fov = 70.42
+    opencv_threads = 1
+    picamera2_threads = 2
+    framerate = 30
+
+    # "camera", "synthetic", "replay:/path/to/frames" or
+    # "recording:/path/to/recording.frt"
+    source = os.environ.get("FRT_SOURCE", "camera")
+    # frames per second for non-camera sources, 0 runs them as fast as possible
+    source_rate = float(os.environ.get("FRT_SOURCE_RATE", 0))
+    # "jpeg" runs the camera through the JpegEncoder, "rgb" and "yuv420" hand
+    # raw buffers to process_frame and skip the encode / decode round trip
+    pixel_format = os.environ.get("FRT_PIXEL_FORMAT", "jpeg")
+
+    # per-stage timings of process_frame, reported under "stages" in /stats
+    stage_timing = os.environ.get("FRT_STAGE_TIMING", "1") != "0"
+
+    # HSV ranges of each color class, on OpenCV's scale: H [0, 180], S and V
+    # [0, 255]; every class gets a "<name>_mask" preview
+    color_ranges = {
+        "red": (((0, 50, 50), (10, 255, 255)), ((170, 50, 50), (180, 255, 255))),
+        "green": (((70, 30, 30), (90, 255, 255)),),
+    }
+    # "hsv" blurs, converts and thresholds the strip, "lut" classifies it
+    # through a quantized BGR lookup table built from color_ranges, "native"
+    # does the same in one pass of the kernel in src/lib (make), falling
+    # back to "lut" when it was not built; measure with api/bench.py before
+    # switching, lut was not faster than hsv in any measurement so far
+    classifier = os.environ.get("FRT_CLASSIFIER", "hsv")
+    # bits kept per channel in the lookup table, 6 makes it 256 KiB
+    lut_bits = 6
+
+    # horizontal bands searched in every frame as name: (center, height),
+    # the center is a fraction of the frame height and a height of None
+    # means cut_frame_height; several bands are scanned in parallel, for
+    # example {"far": [0.35, 24], "near": [0.7, 40]} in FRT_BANDS
+    bands = {
+        "center": (0.5, None),
+    }
+
+    # lower preview quality, scale and rate when frames start being
+    # skipped, see api/governor.py
+    governor = os.environ.get("FRT_GOVERNOR", "1") != "0"
+
+    # previews that look the same as the last one sent are neither resized
+    # nor encoded, clients keep showing the last one; every preview is still
+    # sent at least once in this many frames, 0 sends every frame
+    preview_keyframe = int(os.environ.get("FRT_PREVIEW_KEYFRAME", 30))
+    # mean difference per pixel, in levels of 255, below which a color
+    # preview counts as unchanged; masks have to be identical
+    preview_change_threshold = 3.0
+
+    # flight recorder ring file, see api/recorder.py; empty disables it
+    recorder_path = os.environ.get("FRT_RECORDER", "recording.frt")
+    # "strip" records the strip detection looks at, "frame" the whole frame
+    recorder_mode = os.environ.get("FRT_RECORDER_MODE", "strip")
+    # size of the ring file in MiB, about 45 s of strips at full resolution
+    recorder_size = 256
+
+    # shared memory segment the latest detections are published in for
+    # other processes, see api/shm.py; empty disables it
+    shm_name = os.environ.get("FRT_SHM", "frt_detections")
+
+    # search only around the last detections, see api/tracking.py
+    tracking = os.environ.get("FRT_TRACKING", "0") != "0"
+    # columns added on both sides of the last detections
+    tracking_margin = 96
+    # frames between two full-width scans while tracking
+    rescan_interval = 15
+
+
+# longest class or band name, the detections in api/shm.py and api/recorder.py
+# store names in this many bytes
+name_size = 16
+
+
+def valid_name(name):
+    return isinstance(name, str) and name.isascii() and name.isidentifier() and len(name) <= name_size
+
+
+def parse_color_ranges(text):
+    """Parses {"name": [[[h, s, v], [h, s, v]], ...], ...} into color_ranges."""
+    data = json.loads(text)
+    if not isinstance(data, dict) or not 0 < len(data) < 255:
+        raise ValueError("Color classes must be an object of 1 to 254 classes")
+
+    result = {}
+    for name, ranges in data.items():
+        if not valid_name(name) or name in ("full", "contours"):
+            raise ValueError(f"Invalid color class name \"{name}\", names are ASCII identifiers of up to {name_size} characters")
+        if not isinstance(ranges, list) or len(ranges) == 0:
+            raise ValueError(f"Color class \"{name}\" needs at least one range")
+        parsed = []
+        for bounds in ranges:
+            lower, upper = (tuple(int(v) for v in bound) for bound in bounds)
+            if len(lower) != 3 or len(upper) != 3:
+                raise ValueError(f"Ranges of \"{name}\" must be pairs of [h, s, v] bounds")
+            for bound in (lower, upper):
+                if not (0 <= bound[0] <= 180 and 0 <= bound[1] <= 255 and 0 <= bound[2] <= 255):
+                    raise ValueError(f"Bounds of \"{name}\" must be within H [0, 180], S and V [0, 255]")
+            # hues wrapping around 180, like red, take two ranges instead
+            if any(low > high for low, high in zip(lower, upper)):
+                raise ValueError(f"Lower bounds of \"{name}\" must not be above the upper ones")
+            parsed.append((lower, upper))
+        result[name] = tuple(parsed)
+    return result
+
+
+def parse_bands(text):
+    """Parses {"name": [center, height or null], ...} into bands."""
+    data = json.loads(text)
+    if not isinstance(data, dict) or len(data) == 0:
+        raise ValueError("Bands must be an object of at least one band")
+
+    result = {}
+    for name, (center, height) in data.items():
+        if not valid_name(name):
+            raise ValueError(f"Invalid band name \"{name}\", names are ASCII identifiers of up to {name_size} characters")
+        center = float(center)
+        if not 0 <= center <= 1:
+            raise ValueError(f"Center of band \"{name}\" must be between 0 and 1")
+        if height is not None:
+            height = int(height)
+            if height <= 0:
+                raise ValueError(f"Height of band \"{name}\" must be positive")
+        result[name] = (center, height)
+    return result
+
+
+if "FRT_BANDS" in os.environ:
+    Config.bands = parse_bands(os.environ["FRT_BANDS"])
@@ -0,0 +1,94 @@
+import collections
+
+import numpy as np
+
+from api.config import Config
+from api.vision import rendition
+
+
+class Governor:
+    """Trades preview quality for detection throughput when the Pi is busy.
+
+    Every `window` frames it looks at how long process_frame took compared
+    to the time between two camera frames, and at how many frames the
+    mailbox dropped because the worker was still busy. Under pressure it
+    goes up one level, lowering the JPEG quality and scale of the previews
+    and rendering them on fewer frames; once there is headroom again it
+    steps back down, one level per window. Detections are never affected.
+    """
+
+    # quality cap, scale factor, previews on every n-th frame
+    levels = (
+        (100, 1.0, 1),
+        (75, 1.0, 1),
+        (60, 0.75, 2),
+        (50, 0.5, 3),
+        (40, 0.5, 6),
+    )
+
+    def __init__(self, window = 30):
+        self.window = window
+        self.busy = collections.deque(maxlen = window)
+        self.level = 0
+        self.reset()
+
+    def reset(self):
+        self.busy.clear()
+        self.received = None
+        self.dropped = 0
+        self.load = 0
+        self.skipped = 0
+        self.changes = 0
+
+    def plan(self, renditions, seq):
+        """Maps every requested rendition to the one that is rendered instead.
+
+        Returns an empty plan on frames that get no previews at this level.
+        """
+        quality, scale, interval = self.levels[self.level if Config.governor else 0]
+        if seq % interval != 0:
+            return {}
+        return {
+            requested: rendition(requested.name, requested.scale * scale, min(requested.quality, quality))
+            for requested in renditions
+        }
+
+    def update(self, busy, received, dropped):
+        # frame worker, after every frame
+        self.busy.append(busy)
+        if self.received is None:
+            self.received, self.dropped = received, dropped
+        if len(self.busy) < self.window:
+            return
+
+        self.load = float(np.percentile(np.array(self.busy), 90)) * Config.framerate
+        self.skipped = (dropped - self.dropped) / max(received - self.received, 1)
+        self.received, self.dropped = received, dropped
+        self.busy.clear()
+
+        if not Config.governor:
+            self.level = 0
+        elif (self.skipped > 0.02 or self.load > 0.9) and self.level < len(self.levels) - 1:
+            self.level += 1
+            self.changes += 1
+        elif self.skipped == 0 and self.load < 0.5 and self.level > 0:
+            self.level -= 1
+            self.changes += 1
+
+    def stats(self):
+        quality, scale, interval = self.levels[self.level]
+        return {
+            "enabled": Config.governor,
+            "level": self.level,
+            "max_level": len(self.levels) - 1,
+            "quality_cap": quality,
+            "scale_factor": scale,
+            "preview_interval": interval,
+            # slowest tenth of the last window, in camera frame times
+            "load": round(self.load, 3),
+            "skipped_percent": round(self.skipped * 100, 2),
+            "changes": self.changes,
+        }
+
+
+governor = Governor()
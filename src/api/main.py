@@ -1,22 +1,71 @@
 
-from fastapi import FastAPI, Response, Request, HTTPException, Form, WebSocket
-from fastapi.responses import StreamingResponse
+import time
+
+# startup phases are measured from here, see Startup
+boot = time.perf_counter()
+
+from fastapi import FastAPI, Response, Request, HTTPException, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 import asyncio
+import collections
+import itertools
 import io
+import json
 import logging
-
-from picamera2 import Picamera2
-from picamera2.encoders import JpegEncoder
-from picamera2.outputs import FileOutput
+import struct
+import threading
 
 import cv2
 import numpy as np
-import time
 import base64
 import os
 
+from api.config import Config, parse_color_ranges, parse_bands
+from api.sources import create_source, encode_frame, SyntheticSource
+from api.classify import native, native_error
+from api.vision import Frame, process_frame, rendition, preview_names, default_renditions, preview_changes
+from api.timing import timer
+from api.tracking import trackers
+from api.recorder import recorder
+from api.shm import writer
+from api.governor import governor
+from api.metrics import loop_monitor, FrameRate, Samples, Exposition, resident_memory, process_age
+from api.worker import Mailbox, FrameWorker
+
+
+class Startup:
+    """Boot to first detection, measured once per process.
+
+    The warm-up runs on the frame worker while the source and the camera
+    are being set up; "first_detection" ends once the first camera frame
+    went through process_frame.
+    """
+
+    # phase -> (start, end) in seconds since boot
+    phases = {}
+    # from starting the interpreter to importing this module
+    interpreter = process_age()
+    # when the camera was started and delivered its first frame
+    camera = None
+    first_frame = None
+    warm = False
+    detected = False
+
+
+def mark_phase(name, start, end = None):
+    if end is None:
+        end = time.perf_counter()
+    Startup.phases[name] = (start - boot, end - boot)
+
+
+mark_phase("imports", boot)
+
+
+def ready():
+    return Startup.warm and Startup.detected
+
 
 api = FastAPI()
 
@@ -28,72 +77,438 @@ api.add_middleware(
 )
 
 
-class Config:
-    cut_frame_height = 40
-    full_resolution = (1536, 160)
-    fov = 70.42
-    opencv_threads = 1
-    picamera2_threads = 2
-    framerate = 30
-
-
 class Stats:
-    pass
+    # frames per second over the last seconds, and the age of frames since
+    # their capture when they are processed and when they are sent
+    rate = FrameRate()
+    processed = Samples()
+    sent = Samples()
 
 
 def reset_stats():
     Stats.frames = 0
     Stats.start_time = time.time()
-    Stats.skipped_frames = 0
+    # frames thrown out of full subscriber queues, all clients together
+    Stats.consumer_drops = 0
+    # frames without a usable capture time, timed from their arrival
+    Stats.arrival_timed = 0
+    Stats.rate.reset()
+    Stats.processed.reset()
+    Stats.sent.reset()
+    loop_monitor.reset()
+    governor.reset()
+    cam_output.mailbox.reset()
+    timer.reset()
+    trackers.reset()
+    recorder.reset()
+    preview_changes.reset()
+
+
+# binary preview messages start with the frame's sequence number, its capture
+# timestamp and the index of the stream in preview_names(), followed by the JPEG
+frame_header = struct.Struct('<IdB')
+
+
+class Subscriber:
+    """Bounded frame queue of one stream client.
+
+    "latest" keeps only the newest frame, "keep" keeps the newest `size`
+    frames; either way the oldest frame is dropped when the queue is full.
+    With a non-zero `fps` only frames at least 1 / fps apart are accepted.
+    Subscribers without a rendition only want the detections. Previews
+    that did not change since the client got them are not sent again.
+    """
+
+    ids = itertools.count(1)
+    # fed the source's JPEG buffers as they arrive, see Passthrough
+    passthrough = False
+
+    def __init__(self, rendition, policy = "latest", size = 1, fps = 0):
+        self.id = next(Subscriber.ids)
+        self.rendition = rendition
+        self.policy = policy
+        self.fps = fps
+        self.next_time = 0
+        self.frames = collections.deque(maxlen = 1 if policy == "latest" else size)
+        self.event = asyncio.Event()
+        self.dropped = 0
+        self.sent = 0
+        # how long the last sends to this client took
+        self.send = Samples(100)
+        self.closed = False
+        # version of the last preview queued for the client
+        self.version = -1
+
+    def stream(self):
+        return self.rendition.name if self.rendition is not None else "detections"
+
+    def due(self, timestamp):
+        # half a camera frame of slack, so 15 fps out of 30 doesn't turn
+        # into 10 fps because of jitter
+        return self.fps == 0 or timestamp >= self.next_time - 0.5 / Config.framerate
+
+    def wanted(self, timestamp):
+        # the previews to render for this client in a frame taken at `timestamp`
+        if self.rendition is None or not self.due(timestamp):
+            return ()
+        return (self.rendition,)
+
+    def fresh(self, frame):
+        # whether the frame holds a version of our preview we did not queue yet
+        version = frame.version(self.rendition)
+        return version is not None and version > self.version
+
+    def offer(self, frame):
+        if not self.due(frame.timestamp):
+            return
+        if self.rendition is not None:
+            if not self.fresh(frame):
+                return
+            self.version = frame.version(self.rendition)
+        self.schedule(frame.timestamp)
+        self.push(frame)
+
+    def schedule(self, timestamp):
+        if self.fps != 0:
+            self.next_time += 1 / self.fps
+            if self.next_time <= timestamp:
+                # first frame, or we fell behind: restart the schedule here
+                self.next_time = timestamp + 1 / self.fps
+
+    def push(self, frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+            Stats.consumer_drops += 1
+        self.frames.append(frame)
+        self.event.set()
+
+    async def get(self):
+        # returns None once the client is gone
+        while len(self.frames) == 0:
+            if self.closed:
+                return None
+            self.event.clear()
+            await self.event.wait()
+        self.sent += 1
+        return self.frames.popleft()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    def stats(self):
+        preview = {"stream": self.stream()}
+        if self.rendition is not None:
+            preview["scale"] = self.rendition.scale
+            preview["quality"] = self.rendition.quality
+        send = self.send.quantiles()
+        return {
+            **preview,
+            "id": self.id,
+            "send_p50_ms": round(send["0.5"] * 1000, 3) if send else None,
+            "fps": self.fps,
+            "policy": self.policy,
+            "size": self.frames.maxlen,
+            "queued": len(self.frames),
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
 
 
-lock = False
+class Channels(Subscriber):
+    """Subscriber of one multiplexed /ws connection.
+
+    Any number of previews, the detections and the stats share a single
+    queue, so a frame wakes the connection up once and goes out in one
+    batched message, whatever the client is subscribed to. New previews
+    are kept aside until they are sent, a newer frame without them does
+    not replace them.
+    """
+
+    def __init__(self, fps = 0):
+        super().__init__(None, "latest", 1, fps)
+        # replaced, never changed in place: the worker reads it while rendering
+        self.previews = {}
+        # channel -> (version, jpeg) waiting to be sent, and the version of
+        # the last preview of every channel taken from a frame
+        self.updates = {}
+        self.versions = {}
+        self.detections = False
+        self.stats_interval = None
+        self.next_stats = 0
+
+    def stream(self):
+        return "ws"
+
+    def wanted(self, timestamp):
+        if not self.due(timestamp):
+            return ()
+        return tuple(self.previews.values())
+
+    def offer(self, frame):
+        if not self.due(frame.timestamp):
+            return
+        updates = {}
+        for name, preview in self.previews.items():
+            version = frame.version(preview)
+            if version is not None and version > self.versions.get(name, -1):
+                updates[name] = (version, frame.jpeg(preview))
+        # frames without new previews are only worth it for the detections
+        if not self.detections and len(updates) == 0:
+            return
+        for name, (version, jpeg) in updates.items():
+            self.versions[name] = version
+            self.updates[name] = (version, jpeg)
+        self.schedule(frame.timestamp)
+        self.push(frame)
+
+    def take(self):
+        """The previews to send along with the frame get() returned."""
+        updates, self.updates = self.updates, {}
+        return [(name, jpeg) for name, (version, jpeg) in updates.items()]
+
+    def control(self, message):
+        """Applies a subscribe / unsubscribe message, returns an error or None.
+
+        {"subscribe": "red_mask", "scale": 0.25, "quality": 80}
+        {"subscribe": "stats", "interval": 1}
+        {"unsubscribe": "detections"}
+        """
+        if not isinstance(message, dict):
+            return "Messages must be objects"
+
+        if "subscribe" in message:
+            name = message["subscribe"]
+            if not isinstance(name, str):
+                return "Channel names must be strings"
+            if name == "detections":
+                self.detections = True
+            elif name == "stats":
+                interval = message.get("interval", 1)
+                if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval <= 0:
+                    return "Invalid stats interval"
+                self.stats_interval = interval
+                self.next_stats = 0
+            elif name in preview_names():
+                scale = message.get("scale")
+                quality = message.get("quality")
+                if scale is not None and (not isinstance(scale, (int, float)) or isinstance(scale, bool) or not 0 < scale <= 1):
+                    return "Invalid scale"
+                if quality is not None and (not isinstance(quality, int) or isinstance(quality, bool) or not 1 <= quality <= 100):
+                    return "Invalid quality"
+                self.previews = {**self.previews, name: rendition(name, scale, quality)}
+                # the next frame brings the preview in the new rendition
+                self.versions.pop(name, None)
+                self.updates.pop(name, None)
+            else:
+                return f"Unknown channel \"{name}\""
+
+        elif "unsubscribe" in message:
+            name = message["unsubscribe"]
+            if not isinstance(name, str):
+                return "Channel names must be strings"
+            if name == "detections":
+                self.detections = False
+            elif name == "stats":
+                self.stats_interval = None
+            else:
+                self.previews = {preview: value for preview, value in self.previews.items() if preview != name}
+                self.versions.pop(name, None)
+                self.updates.pop(name, None)
 
+        else:
+            return "Expected \"subscribe\" or \"unsubscribe\""
+        return None
+
+    def stats_timeout(self):
+        # seconds until the stats are due, None when not subscribed to them
+        if self.stats_interval is None:
+            return None
+        return max(self.next_stats - time.monotonic(), 0)
+
+    def stats_due(self):
+        if self.stats_interval is None or time.monotonic() < self.next_stats:
+            return False
+        self.next_stats = time.monotonic() + self.stats_interval
+        return True
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "channels": list(self.previews) + ["detections"] * self.detections + ["stats"] * (self.stats_interval is not None),
+        }
 
-class Frame:
-    def __init__(self):
-        self.full_jpeg = None
-        self.red_mask_jpeg = None
-        self.green_mask_jpeg = None
-        self.contours_jpeg = None
+
+class Passthrough(Subscriber):
+    """Subscriber of a /stream.mjpeg client, queues (jpeg, timestamp) pairs.
+
+    JPEG buffers from the encoder are forwarded as they arrive, before and
+    whether or not the worker processes them, without being decoded or
+    encoded again. Raw pixel formats have no JPEG to forward, then the full
+    frame is rendered at full size like any other preview.
+    """
+
+    passthrough = True
+
+    def __init__(self, fps = 0):
+        super().__init__(rendition("full", 1.0), "latest", 1, fps)
+
+    def stream(self):
+        return "mjpeg"
+
+    def wanted(self, timestamp):
+        if not cam_output.raw:
+            return ()
+        return super().wanted(timestamp)
+
+    def offer(self, frame):
+        if not cam_output.raw:
+            return
+        if self.fresh(frame) and self.due(frame.timestamp):
+            self.version = frame.version(self.rendition)
+            self.schedule(frame.timestamp)
+            self.push((frame.jpeg(self.rendition), frame.timestamp))
+
+    def forward(self, buf, timestamp):
+        if self.due(timestamp):
+            self.schedule(timestamp)
+            self.push((buf, timestamp))
 
 
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
         self.frame = Frame()
-        self.subscribers: dict[str, list[Frame]] = {}
-        self.condition = asyncio.Condition()
-
-    async def _write(self, buf):
-        async with self.condition:
-            process_frame(buf)
-            for frames in self.subscribers.values():
-                frames.append(self.frame)
-            self.condition.notify_all()
-
-    def write(self, buf):
-        if not lock:
-            loop.create_task(self._write(buf))
-        else:
-            Stats.skipped_frames += 1
-
-    def subscribe(self):
+        self.subscribers: dict[str, Subscriber] = {}
+        self.seq = 0
+        # whether the source hands over raw arrays instead of JPEG buffers
+        self.raw = False
+        self.passthroughs = 0
+
+        # frames are processed on a worker thread, the event loop only gets
+        # the finished results; a frame arriving while the worker is busy
+        # replaces the one waiting in the mailbox
+        self.mailbox = Mailbox()
+        self.worker = FrameWorker(self.mailbox, self._process, self._warm_up)
+        self.worker.start()
+
+        # settings waiting to be applied by the worker between two frames
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+    def write(self, buf, timestamp = None):
+        # called from the encoder's or the frame source's thread; without a
+        # capture timestamp from the source, the frame is timed from now
+        if timestamp is None:
+            timestamp = time.time()
+            Stats.arrival_timed += 1
+        if Startup.first_frame is None:
+            Startup.first_frame = time.perf_counter()
+        self.raw = isinstance(buf, np.ndarray)
+        if self.passthroughs > 0 and not self.raw:
+            loop.call_soon_threadsafe(self._forward, buf, timestamp)
+        self.mailbox.put((buf, timestamp))
+
+    def _warm_up(self):
+        # worker thread, while the camera is being configured: the first
+        # real frame shouldn't pay for OpenCV's lazy initialization, the
+        # lookup table and the band threads
+        start = time.perf_counter()
+        cv2.setNumThreads(Config.opencv_threads)
+        buf = encode_frame(SyntheticSource().render(0))
+        process_frame(buf, default_renditions(), record = False)
+        # nothing of the synthetic frame may stick
+        trackers.forget()
+        preview_changes.forget()
+        timer.reset()
+        mark_phase("warm_up", start)
+        Startup.warm = True
+
+    def _process(self, item):
+        # worker thread
+        buf, timestamp = item
+        self.apply_pending()
+        self.seq += 1
+        # under load the governor renders cheaper previews, or none at all
+        plan = governor.plan(self.renditions(timestamp), self.seq)
+        start = time.perf_counter()
+        frame = process_frame(buf, set(plan.values()), self.seq, timestamp)
+        governor.update(time.perf_counter() - start, self.mailbox.received, self.mailbox.dropped)
+        if not Startup.detected:
+            mark_phase("first_frame", Startup.camera, Startup.first_frame)
+            mark_phase("first_detection", Startup.first_frame)
+            Startup.detected = True
+        # subscribers look their previews up by the rendition they asked for
+        frame.previews = {
+            requested: frame.previews[rendered] for requested, rendered in plan.items()
+            if rendered in frame.previews
+        }
+        frame.versions = {
+            requested: frame.versions[rendered] for requested, rendered in plan.items()
+            if rendered in frame.versions
+        }
+        frame.freeze()
+        # straight from the worker, other processes don't wait for the event loop
+        writer.publish(frame)
+        Stats.frames += 1
+        Stats.rate.tick()
+        Stats.processed.add(time.time() - timestamp)
+        loop.call_soon_threadsafe(self._publish, frame)
+
+    def update(self, changes):
+        """Queues Config changes, the returned future is done once they are applied."""
+        done = loop.create_future()
+        with self.pending_lock:
+            self.pending.append((changes, done))
+        return done
+
+    def apply_pending(self):
+        # worker thread, or the event loop when no frames are coming in
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        for changes, done in pending:
+            try:
+                apply_changes(changes)
+            except Exception as e:
+                # the request waiting for them reports it
+                loop.call_soon_threadsafe(done.set_exception, e)
+                continue
+            loop.call_soon_threadsafe(done.set_result, None)
+
+    def _publish(self, frame):
+        self.frame = frame
+        for subscriber in self.subscribers.values():
+            subscriber.offer(frame)
+
+    def _forward(self, buf, timestamp):
+        for subscriber in self.subscribers.values():
+            if subscriber.passthrough:
+                subscriber.forward(buf, timestamp)
+
+    def renditions(self, timestamp):
+        # the previews process_frame has to render: one per distinct rendition
+        # among the subscribers that want this frame
+        subscribers = tuple(self.subscribers.values())
+        return set(
+            rendition for subscriber in subscribers
+            for rendition in subscriber.wanted(timestamp)
+        )
+
+    def subscribe(self, rendition, policy = "latest", size = 1, fps = 0):
+        return self.attach(Subscriber(rendition, policy, size, fps))
+
+    def attach(self, subscriber):
         # generate random key
         key = base64.b64encode(os.urandom(32)).decode('utf-8')
-        self.subscribers[key] = []
+        self.subscribers[key] = subscriber
+        self.passthroughs += subscriber.passthrough
         return key
     
     def unsubscribe(self, key):
-        del self.subscribers[key]
+        subscriber = self.subscribers.pop(key)
+        self.passthroughs -= subscriber.passthrough
 
     async def get_frame(self, key):
-        if len(self.subscribers[key]) == 0:
-            async with self.condition:
-                await self.condition.wait()
-        frame = self.subscribers[key].pop(0)
-        if len(self.subscribers[key]) > Config.framerate:
-            self.subscribers[key].clear()
-        return frame
+        return await self.subscribers[key].get()
 
 
 @api.on_event("startup")
@@ -101,154 +516,482 @@ async def startup():
     global loop
     loop = asyncio.get_running_loop()
 
-    global cam
-    cam = Picamera2()
-
+    # the worker starts warming up right away, alongside everything below
     global cam_output
     cam_output = StreamingOutput()
-    apply_settings()
-    reset_stats()
 
+    global source
+    start = time.perf_counter()
+    source = create_source()
+    mark_phase("source", start)
 
-def apply_settings ():
     try:
-        cam.stop_recording()
-    except:
-        pass
-    config = cam.create_video_configuration(
-        main = {
-            "size": Config.full_resolution,
-        },
-        controls = {
-            "FrameRate": Config.framerate,
-        },
-        #buffer_count = 3,
-        #queue = False,
-    )
-    cam.align_configuration(config)
-    cam.configure(config)
-    cam.start_recording(JpegEncoder(num_threads = Config.picamera2_threads), FileOutput(cam_output))
-
-    cv2.setNumThreads(Config.opencv_threads)
-
-
-def process_frame(raw_jpeg):
-    global lock
-    lock = True
+        recorder.open()
+    except OSError:
+        # detection goes on without the recorder, /stats shows it disabled
+        logging.exception("Opening the flight recorder failed")
+    writer.open()
 
-    frame = cv2.imdecode(np.frombuffer(raw_jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
-    top = frame.shape[0] // 2 - Config.cut_frame_height // 2
-    bottom = frame.shape[0] // 2 + Config.cut_frame_height // 2
+    reset_stats()
+    Startup.camera = time.perf_counter()
+    apply_settings()
+    check_classifier()
+    mark_phase("camera", Startup.camera)
+    loop_monitor.start()
 
-    section = frame[top:bottom, :, :]
 
-    blurred = cv2.GaussianBlur(section, (3, 3), 0)
+@api.on_event("shutdown")
+async def shutdown():
+    loop_monitor.stop()
+    source.stop()
+    cam_output.worker.stop()
+    recorder.close()
+    writer.close()
 
-    # H [0, 360], S [0, 100], V [0, 100]
-    hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
 
-    # Define lower and upper ranges for red color
-    lower_red = np.array([0, 50, 50])
-    upper_red = np.array([10, 255, 255])
-    lower_red2 = np.array([170, 50, 50])
-    upper_red2 = np.array([180, 255, 255])
+def apply_settings ():
+    source.stop()
+    source.start(cam_output)
 
-    # Create mask for red color
-    mask1 = cv2.inRange(hsv, lower_red, upper_red)
-    mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
-    red_mask = mask1 + mask2
+    cv2.setNumThreads(Config.opencv_threads)
+    timer.enabled = Config.stage_timing
 
-    contours, hierarchy = cv2.findContours(red_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
-    if len(contours) > 0:
-        largest_contour = max(contours, key=cv2.contourArea)
-        bounding_rect = cv2.boundingRect(largest_contour)
-        cv2.rectangle(blurred, bounding_rect, (0, 255, 0), 1)
 
-    # Define range of green color in HSV
-    lower_green = np.array([70, 30, 30])
-    upper_green = np.array([90, 255, 255])
+# settings the camera is configured with, changing them restarts the
+# pipeline; all others are picked up by process_frame on the next frame
+restart_settings = ("full_resolution", "framerate", "picamera2_threads")
+# settings the recorder sizes its slots and writes its header with
+layout_settings = ("full_resolution", "cut_frame_height", "bands")
 
-    green_mask = cv2.inRange(hsv, lower_green, upper_green,)
 
-    contours, hierarchy = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
-    if len(contours) > 0:
-        largest_contour = max(contours, key=cv2.contourArea)
-        bounding_rect = cv2.boundingRect(largest_contour)
-        cv2.rectangle(blurred, bounding_rect, (0, 255, 0), 1)
+def running_classifier():
+    # "native" runs as "lut" when the kernel could not be loaded
+    if Config.classifier == "native" and native is None:
+        return "lut"
+    return Config.classifier
 
-    # downscale frame to quarter size
-    small_full = cv2.resize(frame, (0, 0), fx=0.125, fy=0.125)
-    small_red_mask = cv2.resize(red_mask, (0, 0), fx=0.25, fy=0.25)
-    small_green_mask = cv2.resize(green_mask, (0, 0), fx=0.25, fy=0.25)
-    small_contours = cv2.resize(blurred, (0, 0), fx=0.25, fy=0.25)
-    
-    small_full_jpeg = cv2.imencode('.jpg', small_full)[1].tobytes()
-    small_red_mask_jpeg = cv2.imencode('.jpg', small_red_mask)[1].tobytes()
-    small_green_mask_jpeg = cv2.imencode('.jpg', small_green_mask)[1].tobytes()
-    small_contours_jpeg = cv2.imencode('.jpg', small_contours)[1].tobytes()
 
-    cam_output.frame.full_jpeg = base64.b64encode(small_full_jpeg).decode('utf-8')
-    cam_output.frame.red_mask_jpeg = base64.b64encode(small_red_mask_jpeg).decode('utf-8')
-    cam_output.frame.green_mask_jpeg = base64.b64encode(small_green_mask_jpeg).decode('utf-8')
-    cam_output.frame.contours_jpeg = base64.b64encode(small_contours_jpeg).decode('utf-8')
+def check_classifier():
+    if running_classifier() != Config.classifier:
+        logging.warning("Classifier \"native\" runs as \"lut\", the native kernel is not available: %s", native_error)
 
-    # updating stats
-    Stats.frames += 1
 
-    lock = False
+def apply_changes(changes):
+    # all at once, between two frames
+    for name, value in changes.items():
+        setattr(Config, name, value)
+    if "opencv_threads" in changes:
+        cv2.setNumThreads(Config.opencv_threads)
+    if "classifier" in changes:
+        check_classifier()
+    if "bands" in changes:
+        # stages are named after the bands, old ones would be shown forever
+        timer.reset()
+    if any(name in changes for name in layout_settings):
+        recorder.change_layout()
 
 
 @api.websocket('/stream/{name}')
-async def stream(websocket: WebSocket, name: str):
+async def stream(
+    websocket: WebSocket,
+    name: str,
+    mode: str = "text",
+    policy: str = "latest",
+    size: int = 1,
+    fps: float = 0,
+    scale: float = None,
+    quality: int = None,
+):
+    await websocket.accept()
+    if name not in preview_names():
+        await websocket.close(reason = "Invalid stream name")
+        return
+    if mode not in ("text", "binary"):
+        await websocket.close(reason = "Invalid stream mode")
+        return
+    if policy not in ("latest", "keep") or not 1 <= size <= Config.framerate:
+        await websocket.close(reason = "Invalid queue policy")
+        return
+    if fps < 0 or (scale is not None and not 0 < scale <= 1) or (quality is not None and not 1 <= quality <= 100):
+        await websocket.close(reason = "Invalid rendition")
+        return
+    stream_id = preview_names().index(name)
+    preview = rendition(name, scale, quality)
+
+    key = cam_output.subscribe(preview, policy, size, fps)
+    subscriber = cam_output.subscribers[key]
+
+    # unsubscribe even when the client goes away mid-send, otherwise the
+    # preview would keep being rendered for nobody
+    try:
+        while websocket.client_state != 2:
+            frame = await cam_output.get_frame(key)
+            jpeg = frame.jpeg(preview)
+
+            # subscribed after the frame was rendered
+            if jpeg is None:
+                continue
+
+            start = time.perf_counter()
+            if mode == "binary":
+                await websocket.send_bytes(frame_header.pack(frame.seq & 0xffffffff, frame.timestamp, stream_id) + jpeg)
+            else:
+                # base64 text, kept for older GUI builds
+                await websocket.send_text(frame.base64(preview))
+            subscriber.send.add(time.perf_counter() - start)
+            Stats.sent.add(time.time() - frame.timestamp)
+    finally:
+        cam_output.unsubscribe(key)
+
+
+# batched /ws messages start with the frame's sequence number, its capture
+# timestamp and the number of parts; every part is the length of its channel
+# name and of its payload, then the name and the payload itself: a JPEG for
+# previews, JSON for "detections" and "stats"
+batch_header = struct.Struct('<IdB')
+part_header = struct.Struct('<BI')
+
+
+@api.websocket('/ws')
+async def multiplexed(websocket: WebSocket, fps: float = 0):
     await websocket.accept()
-    key = cam_output.subscribe()
+    if fps < 0:
+        await websocket.close(reason = "Invalid rate")
+        return
 
-    while websocket.client_state != 2:
-        frame = await cam_output.get_frame(key)
+    subscriber = Channels(fps)
+    key = cam_output.attach(subscriber)
 
+    async def control():
+        # subscribe / unsubscribe messages, until the client goes away
+        try:
+            while True:
+                try:
+                    message = await websocket.receive_json()
+                except ValueError:
+                    message = None
+                error = subscriber.control(message)
+                if error is not None:
+                    await websocket.send_json({"error": error})
+        except WebSocketDisconnect:
+            pass
+        except Exception:
+            # nobody awaits this task, don't let its errors go unnoticed
+            logging.exception("Handling /ws control messages failed")
+        finally:
+            subscriber.close()
+
+    receiver = asyncio.create_task(control())
+    try:
+        while not subscriber.closed:
+            try:
+                frame = await asyncio.wait_for(subscriber.get(), subscriber.stats_timeout())
+            except asyncio.TimeoutError:
+                # no frame before the stats were due
+                frame = None
+            if frame is None and subscriber.closed:
+                break
+
+            parts = []
+            if frame is not None:
+                parts.extend(subscriber.take())
+                if subscriber.detections:
+                    parts.append(("detections", frame.record_json().encode()))
+            if subscriber.stats_due():
+                try:
+                    parts.append(("stats", json.dumps(stats_record()).encode()))
+                except ZeroDivisionError:
+                    # no frame received yet
+                    pass
+            if len(parts) == 0:
+                continue
+
+            seq, timestamp = (frame.seq, frame.timestamp) if frame is not None else (0, time.time())
+            message = [batch_header.pack(seq & 0xffffffff, timestamp, len(parts))]
+            for name, payload in parts:
+                name = name.encode()
+                message += (part_header.pack(len(name), len(payload)), name, payload)
+
+            start = time.perf_counter()
+            await websocket.send_bytes(b"".join(message))
+            subscriber.send.add(time.perf_counter() - start)
+            if frame is not None:
+                Stats.sent.add(time.time() - frame.timestamp)
+    finally:
+        receiver.cancel()
+        cam_output.unsubscribe(key)
+
+
+@api.get('/stream.mjpeg')
+async def stream_mjpeg(fps: float = 0):
+    """Full resolution video for VLC or an <img>, straight from the encoder."""
+    if fps < 0:
+        raise HTTPException(status_code = 400, detail = "Invalid rate")
+
+    subscriber = Passthrough(fps)
+    key = cam_output.attach(subscriber)
+
+    async def parts():
+        # the JPEG is handed over as is, not joined with its part header
         try:
-            jpeg = getattr(frame, name + '_jpeg')
-        except AttributeError:
-            websocket.close(reason = "Invalid stream name")
+            while True:
+                item = await subscriber.get()
+                if item is None:
+                    break
+                jpeg, timestamp = item
+                start = time.perf_counter()
+                yield b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(jpeg)
+                yield jpeg
+                yield b"\r\n"
+                subscriber.send.add(time.perf_counter() - start)
+                Stats.sent.add(time.time() - timestamp)
+        finally:
+            cam_output.unsubscribe(key)
+
+    return StreamingResponse(parts(), media_type = "multipart/x-mixed-replace; boundary=frame")
+
+
+@api.get('/settings')
+async def settings_get():
+    return {
+        "width": Config.full_resolution[0],
+        "height": Config.full_resolution[1],
+        "fov": Config.fov,
+        "cut_frame_height": Config.cut_frame_height,
+        "opencv_threads": Config.opencv_threads,
+        "picamera2_threads": Config.picamera2_threads,
+        "framerate": Config.framerate,
+        "color_classes": Config.color_ranges,
+        "bands": Config.bands,
+        "classifier": Config.classifier,
+        "tracking": Config.tracking,
+    }
+
+
+@api.websocket('/detections')
+async def detections(websocket: WebSocket, fps: float = 0):
+    await websocket.accept()
+    if fps < 0:
+        await websocket.close(reason = "Invalid rate")
+        return
 
-        if frame is None:
-            continue
+    key = cam_output.subscribe(None, fps = fps)
+    subscriber = cam_output.subscribers[key]
+    try:
+        while websocket.client_state != 2:
+            frame = await cam_output.get_frame(key)
+            start = time.perf_counter()
+            await websocket.send_text(frame.record_json())
+            subscriber.send.add(time.perf_counter() - start)
+            Stats.sent.add(time.time() - frame.timestamp)
+    finally:
+        cam_output.unsubscribe(key)
 
-        await websocket.send_text(jpeg)
 
-    cam_output.unsubscribe(key)
+@api.get('/detections/latest')
+async def detections_latest():
+    return cam_output.frame.record()
 
 
+# every field is optional, only the ones sent are changed
 @api.post('/settings')
 async def settings_post(
-    width: int = Form(),
-    height: int = Form(),
-    fov: str = Form(),
-    cut_frame_height: int = Form(),
-    opencv_threads: int = Form(),
-    picamera2_threads: int = Form(),
-    framerate: int = Form(),
+    width: int = Form(None),
+    height: int = Form(None),
+    fov: str = Form(None),
+    cut_frame_height: int = Form(None),
+    opencv_threads: int = Form(None),
+    picamera2_threads: int = Form(None),
+    framerate: int = Form(None),
+    color_classes: str = Form(None),
+    bands: str = Form(None),
+    classifier: str = Form(None),
+    tracking: bool = Form(None),
 ):
-    Config.full_resolution = (width, height)
-    Config.fov = float(fov)
-    Config.cut_frame_height = cut_frame_height
-    Config.opencv_threads = opencv_threads
-    Config.picamera2_threads = picamera2_threads
-    Config.framerate = framerate
-    apply_settings()
+    start = time.perf_counter()
+
+    values = {
+        "fov": float(fov) if fov is not None else None,
+        "cut_frame_height": cut_frame_height,
+        "opencv_threads": opencv_threads,
+        "picamera2_threads": picamera2_threads,
+        "framerate": framerate,
+        "classifier": classifier,
+        "tracking": tracking,
+    }
+    if width is not None and height is not None:
+        values["full_resolution"] = (width, height)
+    if color_classes is not None:
+        try:
+            values["color_ranges"] = parse_color_ranges(color_classes)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code = 400, detail = f"Invalid color classes: {e}")
+    if bands is not None:
+        try:
+            values["bands"] = parse_bands(bands)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code = 400, detail = f"Invalid bands: {e}")
+    if classifier is not None and classifier not in ("hsv", "lut", "native"):
+        raise HTTPException(status_code = 400, detail = f"Unknown classifier \"{classifier}\"")
+
+    # forms send every field, only what actually changes is applied
+    changes = {
+        name: value for name, value in values.items()
+        if value is not None and value != getattr(Config, name)
+    }
+    if len(changes) == 0:
+        path = "none"
+    else:
+        done = cam_output.update(changes)
+        try:
+            try:
+                await asyncio.wait_for(asyncio.shield(done), timeout = 1)
+            except asyncio.TimeoutError:
+                # no frames are coming in, so there is no frame to race with
+                cam_output.apply_pending()
+                await done
+        except Exception as e:
+            logging.exception("Applying settings failed")
+            raise HTTPException(status_code = 500, detail = f"Applying the settings failed: {e}")
+
+        path = "hot"
+        if any(name in changes for name in restart_settings):
+            path = "restart"
+            apply_settings()
+
+    return {
+        "path": path,
+        "changed": sorted(changes),
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+def stats_record():
+    return {
+        "avg_fps": round(Stats.frames / (time.time() - Stats.start_time), 2),
+        "fps": {
+            "1s": round(Stats.rate.rate(1), 2),
+            "5s": round(Stats.rate.rate(5), 2),
+            "30s": round(Stats.rate.rate(30), 2),
+        },
+        # from the capture timestamp to the end of process_frame and to
+        # the end of the WebSocket send; the capture is the start of the
+        # exposure for the camera ("sensor") and the time a frame was
+        # produced for the other sources ("source"), frames without one
+        # count from their arrival
+        "latency": {
+            "capture_clock": source.clock,
+            "arrival_timed_frames": Stats.arrival_timed,
+            "capture_to_processed": Stats.processed.summary(),
+            "capture_to_sent": Stats.sent.summary(),
+        },
+        "skipped_frames": cam_output.mailbox.dropped,
+        "skipped_frames_percent": round(cam_output.mailbox.dropped / cam_output.mailbox.received * 100, 2),
+        "stages": timer.summary(),
+        "classifier": {
+            "configured": Config.classifier,
+            "running": running_classifier(),
+            "native_error": native_error,
+        },
+        "tracking": trackers.stats(),
+        "governor": governor.stats(),
+        "recorder": recorder.stats(),
+        "startup": startup_record(),
+        # renditions encoded and skipped because they did not change
+        "previews": preview_changes.stats(),
+        "subscribers": [subscriber.stats() for subscriber in list(cam_output.subscribers.values())],
+    }
+
+
+def startup_record():
+    return {
+        "ready": ready(),
+        "interpreter_ms": round(Startup.interpreter * 1000, 3) if Startup.interpreter is not None else None,
+        # in milliseconds since this module started importing
+        "phases": {
+            name: {
+                "start_ms": round(start * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+            }
+            for name, (start, end) in list(Startup.phases.items())
+        },
+        "boot_to_first_detection_ms": round(Startup.phases["first_detection"][1] * 1000, 3) if Startup.detected else None,
+    }
+
+
+@api.get('/ready')
+async def ready_get(response: Response):
+    """200 once the pipeline is warmed up and the first frame was processed, 503 until then."""
+    if not ready():
+        response.status_code = 503
+    return startup_record()
 
 
 @api.get('/stats')
 async def stats():
     try:
-        return {
-            "avg_fps": round(Stats.frames / (time.time() - Stats.start_time), 2),
-            "skipped_frames": Stats.skipped_frames,
-            "skipped_frames_percent": round(Stats.skipped_frames / (Stats.frames + Stats.skipped_frames) * 100, 2),
-        }
+        return stats_record()
     except:
         pass
 
 @api.post('/reset_stats')
 async def reset_stats_post():
     reset_stats()
+
+
+@api.get('/metrics')
+async def metrics():
+    """Prometheus text format, for logging and graphing long test runs."""
+    page = Exposition()
+    page.add("frt_frames_processed_total", "counter", "Frames run through process_frame.", Stats.frames)
+    page.add("frt_frames_received_total", "counter", "Frames handed over by the frame source.", cam_output.mailbox.received)
+    page.add("frt_frames_dropped_total", "counter", "Frames dropped before processing or before being sent.", [
+        ({"reason": "busy_worker"}, cam_output.mailbox.dropped),
+        ({"reason": "slow_consumer"}, Stats.consumer_drops),
+    ])
+    page.add("frt_fps", "gauge", "Frames processed per second over a sliding window.", [
+        ({"window": f"{seconds}s"}, Stats.rate.rate(seconds)) for seconds in (1, 5, 30)
+    ])
+    # clock "sensor" counts from the start of the exposure, "source" from
+    # the time a non-camera source produced the frame
+    page.summary("frt_capture_to_processed_seconds", "Age of a frame since its capture when process_frame is done with it.", [
+        ({"clock": source.clock}, Stats.processed.quantiles(), Stats.processed.total, Stats.processed.count),
+    ])
+    page.summary("frt_capture_to_sent_seconds", "Age of a frame since its capture when it was sent to a client.", [
+        ({"clock": source.clock}, Stats.sent.quantiles(), Stats.sent.total, Stats.sent.count),
+    ])
+    page.add("frt_frames_arrival_timed_total", "counter", "Frames without a usable capture time, aged from their arrival instead.", Stats.arrival_timed)
+    page.add("frt_previews_total", "counter", "Previews encoded, or skipped because they did not change.", [
+        ({"stream": name, "result": result}, count)
+        for name, counts in preview_changes.stats().items()
+        for result, count in (("encoded", counts["encoded"]), ("skipped", counts["skipped"]))
+    ])
+    page.add("frt_ready", "gauge", "1 once the pipeline is warmed up and processed its first frame.", int(ready()))
+    page.add("frt_startup_phase_seconds", "gauge", "Duration of each startup phase.", [
+        ({"phase": name}, end - start) for name, (start, end) in list(Startup.phases.items())
+    ])
+    page.add("frt_governor_level", "gauge", "Preview degradation level, 0 renders previews as requested.", governor.level)
+    page.summary("frt_event_loop_lag_seconds", "How late the event loop woke up from a short sleep.", [
+        ({}, loop_monitor.lag.quantiles(), loop_monitor.lag.total, loop_monitor.lag.count),
+    ])
+
+    subscribers = list(cam_output.subscribers.values())
+    def labels(subscriber):
+        return {
+            "id": subscriber.id,
+            "stream": subscriber.stream(),
+        }
+    page.add("frt_subscribers", "gauge", "Connected stream and detection clients.", len(subscribers))
+    page.add("frt_subscriber_pending_frames", "gauge", "Frames queued for a client.", [
+        (labels(subscriber), len(subscriber.frames)) for subscriber in subscribers
+    ])
+    page.add("frt_subscriber_dropped_total", "counter", "Frames dropped from a client's full queue.", [
+        (labels(subscriber), subscriber.dropped) for subscriber in subscribers
+    ])
+    page.summary("frt_subscriber_send_seconds", "Time spent sending one message to a client.", [
+        (labels(subscriber), subscriber.send.quantiles(), subscriber.send.total, subscriber.send.count) for subscriber in subscribers
+    ])
+
+    page.add("process_cpu_seconds_total", "counter", "User and system CPU time of the process.", time.process_time())
+    page.add("process_resident_memory_bytes", "gauge", "Resident memory of the process.", resident_memory())
+    return PlainTextResponse(page.text(), media_type = "text/plain; version=0.0.4")
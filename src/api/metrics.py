@@ -0,0 +1,166 @@
+import asyncio
+import collections
+import os
+import resource
+import time
+
+import numpy as np
+
+
+class FrameRate:
+    """Frames per second over the last few seconds, not since startup."""
+
+    def __init__(self, horizon = 30):
+        self.horizon = horizon
+        self.times = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self.times.clear()
+        self.started = time.monotonic()
+
+    def tick(self):
+        # only called from the frame worker
+        now = time.monotonic()
+        self.times.append(now)
+        while len(self.times) > 0 and self.times[0] < now - self.horizon:
+            self.times.popleft()
+
+    def rate(self, seconds):
+        now = time.monotonic()
+        times = list(self.times)
+        # right after a reset the window is shorter than asked for
+        span = min(seconds, now - self.started)
+        if span <= 0:
+            return 0
+        return sum(1 for t in times if t >= now - seconds) / span
+
+
+class Samples:
+    """The last `size` values of something, percentiles on demand."""
+
+    def __init__(self, size = 600):
+        self.values = collections.deque(maxlen = size)
+        self.reset()
+
+    def reset(self):
+        self.values.clear()
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.values.append(value)
+        self.total += value
+        self.count += 1
+
+    def quantiles(self):
+        if len(self.values) == 0:
+            return {}
+        values = np.percentile(np.array(self.values), (50, 90, 95, 99))
+        return dict(zip(("0.5", "0.9", "0.95", "0.99"), (float(v) for v in values)))
+
+    def summary(self):
+        quantiles = self.quantiles()
+        if len(quantiles) == 0:
+            return None
+        return {
+            "p50_ms": round(quantiles["0.5"] * 1000, 3),
+            "p95_ms": round(quantiles["0.95"] * 1000, 3),
+            "p99_ms": round(quantiles["0.99"] * 1000, 3),
+            "samples": len(self.values),
+        }
+
+
+class LoopMonitor:
+    """Measures how late the event loop wakes up from a short sleep.
+
+    Anything blocking the loop, a slow handler or a send stuck in the
+    kernel, shows up as lag in every client at once.
+    """
+
+    def __init__(self, interval = 0.05, size = 1200):
+        self.interval = interval
+        self.lag = Samples(size)
+        self.task = None
+
+    def reset(self):
+        self.lag.reset()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag.add(max(time.perf_counter() - start - self.interval, 0))
+
+
+def resident_memory():
+    # /proc only exists on Linux, elsewhere fall back to the peak
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_age():
+    """Seconds since the process was started, None where /proc is missing."""
+    try:
+        with open("/proc/self/stat") as file:
+            # the command name may contain spaces, the fields after it don't
+            started = int(file.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+    except OSError:
+        return None
+    return uptime - started
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels.items()) + "}"
+
+
+def _number(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Exposition:
+    """Builds a page in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help, samples):
+        """`samples` is a number or a list of (labels, value) pairs."""
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def summary(self, name, help, series):
+        """`series` is a list of (labels, quantiles, sum, count)."""
+        self.lines.append(f"# HELP {name} {help}")
+        self.lines.append(f"# TYPE {name} summary")
+        for labels, quantiles, total, count in series:
+            for quantile, value in quantiles.items():
+                self.lines.append(f"{name}{_labels({**labels, 'quantile': quantile})} {_number(value)}")
+            self.lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+            self.lines.append(f"{name}_count{_labels(labels)} {_number(count)}")
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,368 @@
+"""Flight recorder keeping the last frames and their detections on disk.
+
+Frames go into a fixed-size ring file that is memory mapped: recording
+one is a copy into the page cache, and the kernel writes it back in the
+background, so the vision loop never waits for the disk. The recording of
+the previous run is kept next to it as <path>.prev.
+
+Run from the src directory:
+
+    python -m api.recorder info recording.frt
+    python -m api.recorder replay recording.frt
+    python -m api.recorder export recording.frt frames/
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+from api.config import Config
+
+
+magic = b"FRTREC01"
+# magic, slot count, slot size, image capacity, detections per slot, mode, bands
+file_header = struct.Struct('<8sIIII8sI')
+# first seq recorded with the layout, length of the layout that follows as
+# JSON; files without it have zeros here
+layout_header = struct.Struct('<QI')
+header_size = 4096
+# seq, timestamp, top, height, width, channels (0 for I420), detections, commit
+slot_header = struct.Struct('<QdiiiiiQ')
+# class, x, y, w, h, area, bearing
+detection_record = struct.Struct('<16siiiiff')
+max_detections = 16
+
+
+def _round_up(size, alignment = 4096):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def image_capacity(mode = None):
+    """Bytes needed to record one frame at the current resolution."""
+    if mode is None:
+        mode = Config.recorder_mode
+    width, height = Config.full_resolution
+    if mode == "frame":
+        return width * height * 3
+    # the strips of all bands, one under the other
+    heights = (band_height if band_height is not None else Config.cut_frame_height for center, band_height in Config.bands.values())
+    return width * sum(heights) * 3
+
+
+class Recorder:
+    """Writes frames into the ring file, from the frame worker only."""
+
+    def __init__(self):
+        self.file = None
+        self.map = None
+        self.mode = None
+        self.slots = 0
+        self.index = 0
+        self.views = []
+        self.names = {}
+        self.relayout = False
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.truncated = 0
+
+    def open(self, path = None, size = None, mode = None, previous = ".prev"):
+        """Starts a new ring file, an existing one is kept as <path><previous>."""
+        if path is None:
+            path = Config.recorder_path
+        if size is None:
+            size = Config.recorder_size * 1024 * 1024
+        self.close()
+        if path == "":
+            return
+
+        if os.path.exists(path):
+            os.replace(path, path + previous)
+
+        self.mode = mode if mode is not None else Config.recorder_mode
+        self.capacity = image_capacity(self.mode)
+        self.slot_size = _round_up(slot_header.size + max_detections * detection_record.size + self.capacity)
+        self.slots = max(1, (size - header_size) // self.slot_size)
+
+        self.file = open(path, "w+b")
+        try:
+            # writing to a hole of a sparse file on a full disk is a SIGBUS
+            # in the middle of a run, claim the space now
+            os.posix_fallocate(self.file.fileno(), 0, header_size + self.slots * self.slot_size)
+        except OSError:
+            self.file.close()
+            os.remove(path)
+            self.file = None
+            self.mode = None
+            self.slots = 0
+            raise
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self._write_header(0)
+        # one image view per slot, rebuilt only when the frame shape changes
+        self.views = [None] * self.slots
+        self.index = 0
+        self.path = path
+
+    def _write_header(self, since):
+        layout = json.dumps({"bands": Config.bands, "cut_frame_height": Config.cut_frame_height}).encode()
+        if layout_header.size + len(layout) > header_size - file_header.size:
+            raise ValueError("The bands do not fit into the recording header")
+        file_header.pack_into(self.map, 0, magic, self.slots, self.slot_size, self.capacity, max_detections, self.mode.encode(), len(Config.bands))
+        layout_header.pack_into(self.map, file_header.size, since, len(layout))
+        offset = file_header.size + layout_header.size
+        self.map[offset:offset + len(layout)] = layout
+
+    def change_layout(self):
+        """Takes the bands, strip height or resolution changing into account.
+
+        A frame that no longer fits its slots reopens the file, the frames
+        recorded so far are kept as <path>.resized and <path>.prev stays the
+        recording of the previous run. Smaller frames are recorded into the
+        slots as they are, every slot stores the shape of its image, and the
+        new layout goes into the header with the next frame.
+        """
+        if self.map is None:
+            return
+        if image_capacity(self.mode) > self.capacity:
+            self.open(self.path, mode = self.mode, previous = ".resized")
+        else:
+            self.relayout = True
+
+    def close(self):
+        # the image views keep the map exported, drop them first
+        self.views = []
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+        self.map = None
+        self.file = None
+        self.mode = None
+
+    def _view(self, slot, image):
+        view = self.views[slot]
+        if view is None or view.shape != image.shape:
+            offset = header_size + slot * self.slot_size + slot_header.size + max_detections * detection_record.size
+            view = self.views[slot] = np.ndarray(image.shape, dtype = np.uint8, buffer = self.map, offset = offset)
+        return view
+
+    def _name(self, name):
+        encoded = self.names.get(name)
+        if encoded is None:
+            # the configuration keeps names within the field, see valid_name
+            encoded = self.names[name] = name.encode()
+        return encoded
+
+    def record(self, seq, timestamp, frame, section, top, detections):
+        if self.map is None:
+            return
+        if self.relayout:
+            self._write_header(seq)
+            self.relayout = False
+        image = frame if self.mode == "frame" else section
+        if image.dtype != np.uint8 or image.nbytes > self.capacity:
+            # the resolution grew since the file was sized, keep the detections
+            self.truncated += 1
+            image = None
+
+        slot = self.index
+        self.index = (self.index + 1) % self.slots
+        offset = header_size + slot * self.slot_size
+
+        # readers only trust slots whose commit matches their seq
+        slot_header.pack_into(self.map, offset, 0, 0, 0, 0, 0, 0, 0, 0)
+        if image is not None:
+            np.copyto(self._view(slot, image), image)
+            height, width = image.shape[:2]
+            channels = image.shape[2] if image.ndim == 3 else 0
+        else:
+            height = width = channels = 0
+
+        count = min(len(detections), max_detections)
+        position = offset + slot_header.size
+        for i in range(count):
+            detection = detections[i]
+            x, y, w, h = detection["bbox"]
+            detection_record.pack_into(
+                self.map, position, self._name(detection["class"]),
+                x, y, w, h, detection["area"], detection["bearing"],
+            )
+            position += detection_record.size
+
+        slot_header.pack_into(self.map, offset, seq, timestamp, top, height, width, channels, count, 0)
+        struct.pack_into('<Q', self.map, offset + slot_header.size - 8, seq)
+        self.frames += 1
+
+    def stats(self):
+        return {
+            "enabled": self.map is not None,
+            "mode": self.mode,
+            "frames": self.frames,
+            "slots": self.slots,
+            "truncated": self.truncated,
+        }
+
+
+class Recording:
+    """Reads a ring file, also while it is still being written."""
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        found, self.slots, self.slot_size, self.capacity, self.max_detections, mode, self.bands = file_header.unpack_from(self.map, 0)
+        if found != magic:
+            raise ValueError(f"\"{path}\" is not a recording")
+        self.mode = mode.rstrip(b"\0").decode()
+        # bands and strip height of the frames from seq `since` on
+        self.since, length = layout_header.unpack_from(self.map, file_header.size)
+        self.layout = None
+        if length > 0:
+            offset = file_header.size + layout_header.size
+            self.layout = json.loads(bytes(self.map[offset:offset + length]))
+
+    def read(self, slot):
+        """Returns (seq, timestamp, top, image, detections) or None."""
+        offset = header_size + slot * self.slot_size
+        seq, timestamp, top, height, width, channels, count, commit = slot_header.unpack_from(self.map, offset)
+        if seq == 0 or commit != seq:
+            return None
+
+        image = None
+        if height > 0:
+            shape = (height, width, channels) if channels > 0 else (height, width)
+            start = offset + slot_header.size + self.max_detections * detection_record.size
+            image = np.frombuffer(self.map, dtype = np.uint8, count = int(np.prod(shape)), offset = start).reshape(shape).copy()
+
+        detections = []
+        position = offset + slot_header.size
+        for _ in range(count):
+            name, x, y, w, h, area, bearing = detection_record.unpack_from(self.map, position)
+            detections.append({
+                "class": name.rstrip(b"\0").decode(errors = "replace"),
+                "bbox": [x, y, w, h],
+                "area": round(area, 1),
+                "bearing": round(bearing, 2),
+            })
+            position += detection_record.size
+
+        # the writer may have reused the slot while we were copying it
+        if struct.unpack_from('<Q', self.map, offset + slot_header.size - 8)[0] != seq:
+            return None
+        return seq, timestamp, top, image, detections
+
+    def frames(self):
+        """Every complete frame in the file, oldest first."""
+        frames = [frame for frame in (self.read(slot) for slot in range(self.slots)) if frame is not None]
+        frames.sort(key = lambda frame: frame[0])
+        return frames
+
+    def close(self):
+        self.map.close()
+
+
+def use_recorded_layout(recording, image):
+    """Sets up Config to look at the recorded images the way they were recorded."""
+    if recording.mode != "strip":
+        if recording.layout is not None:
+            Config.bands = {name: tuple(band) for name, band in recording.layout["bands"].items()}
+            Config.cut_frame_height = recording.layout["cut_frame_height"]
+        return
+    if recording.bands > 1:
+        raise ValueError("Strips of several bands can only be exported, record whole frames to replay them")
+    # the recorded strip is looked at as a whole
+    Config.bands = {"recorded": (0.5, None)}
+    Config.cut_frame_height = image.shape[0]
+
+
+def _strip_coordinates(detections, top):
+    return sorted((d["class"], d["bbox"][0], d["bbox"][1] - top, d["bbox"][2], d["bbox"][3]) for d in detections)
+
+
+def info(args):
+    recording = Recording(args.path)
+    frames = recording.frames()
+    print("%s recording, %d slots of %d bytes, %d frames recorded" % (recording.mode, recording.slots, recording.slot_size, len(frames)))
+    if len(frames) > 0:
+        first, last = frames[0], frames[-1]
+        print("seq %d to %d, %.2f s" % (first[0], last[0], last[1] - first[1]))
+    if recording.layout is not None:
+        print("bands %s, cut_frame_height %d, since seq %d" % (json.dumps(recording.layout["bands"]), recording.layout["cut_frame_height"], recording.since))
+    if args.detections:
+        for seq, timestamp, top, image, detections in frames:
+            print(seq, "%.3f" % timestamp, detections)
+
+
+def replay(args):
+    """Runs the recorded frames through process_frame again."""
+    from api.vision import process_frame
+
+    recording = Recording(args.path)
+    differing = 0
+    frames = recording.frames()
+    # frames from before the last layout change were searched differently
+    earlier = sum(1 for frame in frames if frame[0] < recording.since)
+    frames = frames[earlier:]
+    for seq, timestamp, top, image, detections in frames:
+        if image is None:
+            continue
+        use_recorded_layout(recording, image)
+        result = process_frame(image, (), seq, timestamp)
+        # compare in strip coordinates, the strip of a recorded strip starts at 0
+        new_top = 0 if recording.mode == "strip" else top
+        if _strip_coordinates(result.detections, new_top) != _strip_coordinates(detections, top):
+            differing += 1
+            if args.verbose:
+                print(seq, "recorded", detections, "replayed", result.detections)
+    print("%d frames replayed, %d with different detections" % (len(frames), differing))
+    if earlier > 0:
+        print("%d frames recorded before the layout changed were skipped" % earlier)
+    return differing
+
+
+def export(args):
+    import cv2
+
+    os.makedirs(args.directory, exist_ok = True)
+    for seq, timestamp, top, image, detections in Recording(args.path).frames():
+        if image is None:
+            continue
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_YUV2BGR_I420)
+        cv2.imwrite(os.path.join(args.directory, "%08d.png" % seq), image)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Inspect and replay flight recordings.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    command = commands.add_parser("info", help = "summary of a recording")
+    command.add_argument("path")
+    command.add_argument("--detections", action = "store_true", help = "print the detections of every frame")
+    command.set_defaults(run = info)
+
+    command = commands.add_parser("replay", help = "run the recorded frames through process_frame")
+    command.add_argument("path")
+    command.add_argument("--verbose", action = "store_true", help = "print every frame with different detections")
+    command.set_defaults(run = replay)
+
+    command = commands.add_parser("export", help = "write the recorded images as PNG files")
+    command.add_argument("path")
+    command.add_argument("directory")
+    command.set_defaults(run = export)
+
+    args = parser.parse_args()
+    if args.run(args):
+        sys.exit(1)
+
+
+recorder = Recorder()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Latest detections in shared memory, for processes on the same board.
+
+The frame worker publishes every frame's detections into a small
+multiprocessing.shared_memory segment guarded by a seqlock: the writer
+makes the sequence counter odd, writes the record and makes it even
+again, readers retry until they copied the record between two equal,
+even reads of the counter. Neither side ever waits for the other.
+
+A control process reads them like this, from the src directory or with
+it on the path:
+
+    from api.shm import DetectionReader
+
+    reader = DetectionReader()
+    seq, timestamp, detections = reader.read()
+
+or watches them with `python -m api.shm`.
+"""
+
+import argparse
+import collections
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from api.config import Config
+
+
+magic = b"FRTSHM01"
+# magic, detections per record, size of one detection
+header = struct.Struct('<8sII')
+# seqlock counter, odd while the record is being written
+counter = struct.Struct('<Q')
+counter_offset = 16
+# frame seq, capture timestamp, number of detections
+record = struct.Struct('<QdI')
+record_offset = 24
+# class, band, x, y, w, h, area, bearing
+detection = struct.Struct('<16s16siiiiff')
+detections_offset = 48
+max_detections = 64
+
+Detection = collections.namedtuple("Detection", ("name", "band", "x", "y", "w", "h", "area", "bearing"))
+
+_barrier = threading.Lock()
+
+
+def _fence():
+    # taking a lock is a full memory barrier, which keeps the counter and
+    # the record in order on weakly ordered CPUs like the Pi's
+    with _barrier:
+        pass
+
+
+class DetectionWriter:
+    """Publishes the detections of every frame, from a single thread."""
+
+    def __init__(self):
+        self.memory = None
+        self.sequence = 0
+        self.names = {}
+
+    def open(self, name = None):
+        if name is None:
+            name = Config.shm_name
+        self.close()
+        if name == "":
+            return
+
+        size = detections_offset + max_detections * detection.size
+        try:
+            self.memory = shared_memory.SharedMemory(name, create = True, size = size)
+        except FileExistsError:
+            # left behind by a run that did not shut down cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name, create = True, size = size)
+        header.pack_into(self.memory.buf, 0, magic, max_detections, detection.size)
+        self.sequence = 0
+        counter.pack_into(self.memory.buf, counter_offset, self.sequence)
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+        self.memory = None
+
+    def _name(self, name):
+        encoded = self.names.get(name)
+        if encoded is None:
+            # the configuration keeps names within the field, see valid_name
+            encoded = self.names[name] = (name or "").encode()
+        return encoded
+
+    def publish(self, frame):
+        if self.memory is None:
+            return
+        buf = self.memory.buf
+        count = min(len(frame.detections), max_detections)
+
+        self.sequence += 1
+        counter.pack_into(buf, counter_offset, self.sequence)
+        _fence()
+
+        record.pack_into(buf, record_offset, frame.seq, frame.timestamp, count)
+        position = detections_offset
+        for i in range(count):
+            found = frame.detections[i]
+            x, y, w, h = found["bbox"]
+            detection.pack_into(
+                buf, position, self._name(found["class"]), self._name(found.get("band")),
+                x, y, w, h, found["area"], found["bearing"],
+            )
+            position += detection.size
+
+        _fence()
+        self.sequence += 1
+        counter.pack_into(buf, counter_offset, self.sequence)
+
+
+class DetectionReader:
+    """Reads the latest detections published by the vision pipeline."""
+
+    def __init__(self, name = None):
+        if name is None:
+            name = Config.shm_name
+        try:
+            self.memory = shared_memory.SharedMemory(name, track = False)
+        except TypeError:
+            # before Python 3.13 every attached process unlinks the segment
+            # when it exits, unless it is taken off the resource tracker
+            from multiprocessing import resource_tracker
+            self.memory = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+
+        found, self.max_detections, size = header.unpack_from(self.memory.buf, 0)
+        if found != magic or size != detection.size:
+            raise ValueError(f"\"{name}\" does not hold detections")
+
+    def read(self, retries = 1000):
+        """Returns (seq, timestamp, detections) of the latest frame.
+
+        seq is 0 until the first frame was published. Raises TimeoutError
+        when the writer kept changing the record for `retries` attempts.
+        """
+        buf = self.memory.buf
+        for _ in range(retries):
+            before = counter.unpack_from(buf, counter_offset)[0]
+            if before & 1:
+                continue
+            _fence()
+            seq, timestamp, count = record.unpack_from(buf, record_offset)
+            count = min(count, self.max_detections)
+            data = bytes(buf[detections_offset:detections_offset + count * detection.size])
+            _fence()
+            if counter.unpack_from(buf, counter_offset)[0] != before:
+                continue
+
+            detections = []
+            for name, band, x, y, w, h, area, bearing in detection.iter_unpack(data):
+                # stored as float32, rounded like the JSON records
+                detections.append(Detection(name.rstrip(b"\0").decode(errors = "replace"), band.rstrip(b"\0").decode(errors = "replace"), x, y, w, h, round(area, 1), round(bearing, 2)))
+            return seq, timestamp, detections
+        raise TimeoutError("Detections kept changing while being read")
+
+    def close(self):
+        self.memory.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Prints the detections published in shared memory.")
+    parser.add_argument("--name", default = Config.shm_name, help = "name of the shared memory segment")
+    parser.add_argument("--interval", type = float, default = 0.01, help = "seconds between two polls")
+    args = parser.parse_args()
+
+    reader = DetectionReader(args.name)
+    last = None
+    while True:
+        start = time.perf_counter()
+        seq, timestamp, detections = reader.read()
+        elapsed = time.perf_counter() - start
+        if seq != last:
+            last = seq
+            print("%d  %.3f  read in %.1f us  %s" % (seq, timestamp, elapsed * 1e6, detections), flush = True)
+        time.sleep(args.interval)
+
+
+writer = DetectionWriter()
+
+
+if __name__ == "__main__":
+    main()
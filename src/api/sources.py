@@ -0,0 +1,316 @@
+import glob
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from api.config import Config
+
+
+def encode_frame(image, pixel_format = None):
+    """Converts a BGR image into the layout produced by the camera."""
+    if pixel_format is None:
+        pixel_format = Config.pixel_format
+    if pixel_format == "jpeg":
+        return cv2.imencode('.jpg', image)[1].tobytes()
+    if pixel_format == "rgb":
+        # Picamera2's RGB888 is stored in BGR order, just like OpenCV's images
+        return np.ascontiguousarray(image)
+    if pixel_format == "yuv420":
+        return cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)
+    raise ValueError(f"Unknown pixel format \"{pixel_format}\"")
+
+
+def sensor_time(sensor_timestamp):
+    """Wall clock time of a libcamera SensorTimestamp.
+
+    SensorTimestamp counts nanoseconds on CLOCK_MONOTONIC; when it does not
+    look like it, None, and the frame is timed from its arrival instead.
+    """
+    if sensor_timestamp is None:
+        return None
+    age = (time.monotonic_ns() - sensor_timestamp) / 1e9
+    if not 0 <= age < 1:
+        return None
+    return time.time() - age
+
+
+def encoded_output(output, encoder):
+    """picamera2 output handing the encoder's JPEGs to `output` with the
+    time they were captured, like capture() does for raw frames.
+
+    The encoder stamps frames in microseconds of their SensorTimestamp,
+    recent picamera2 versions counting from the first frame's.
+    """
+    from picamera2.outputs import Output
+
+    class EncodedOutput(Output):
+        def outputframe(self, frame, keyframe = True, timestamp = None, *args, **kwargs):
+            captured = None
+            if timestamp is not None:
+                first = getattr(encoder, "firsttimestamp", None) or 0
+                captured = sensor_time((timestamp + first) * 1000)
+            output.write(frame, captured)
+
+    return EncodedOutput()
+
+
+class FrameSource:
+    """Feeds frames into a StreamingOutput.
+
+    Sources that are not driven by the camera implement read() and get a
+    thread from start() that pushes frames at `rate` fps (or as fast as
+    possible when the rate is 0 / None). capture() can be overridden to
+    hand over the time a frame was captured along with it, `clock` says
+    what that time stands for.
+    """
+
+    clock = "source"
+
+    def __init__(self, rate = None):
+        self.rate = rate
+        self.output = None
+        self.thread = None
+        self.running = False
+
+    def read(self):
+        raise NotImplementedError
+
+    def capture(self):
+        # the time the source produced the frame
+        return self.read(), time.time()
+
+    def start(self, output):
+        self.output = output
+        self.running = True
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while self.running:
+            buf, timestamp = self.capture()
+            if buf is None:
+                break
+            self.output.write(buf, timestamp)
+
+            if self.rate:
+                next_time += 1 / self.rate
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # we are behind, don't try to catch up with a burst
+                    next_time = time.perf_counter()
+
+
+class CameraSource(FrameSource):
+    # the start of the exposure, from the frame's SensorTimestamp
+    clock = "sensor"
+    formats = {
+        "rgb": "RGB888",
+        "yuv420": "YUV420",
+    }
+
+    def __init__(self):
+        super().__init__()
+        from picamera2 import Picamera2
+        self.cam = Picamera2()
+        self.pixel_format = None
+
+    def read(self):
+        return self.capture()[0]
+
+    def capture(self):
+        # only used for raw formats, blocks until the next frame; the frame's
+        # metadata says when its exposure started
+        request = self.cam.capture_request()
+        try:
+            buf = request.make_array("main")
+            timestamp = sensor_time(request.get_metadata().get("SensorTimestamp"))
+        finally:
+            request.release()
+        return buf, timestamp
+
+    def start(self, output):
+        from picamera2.encoders import JpegEncoder
+
+        self.output = output
+        self.pixel_format = Config.pixel_format
+        main = {
+            "size": Config.full_resolution,
+        }
+        if self.pixel_format != "jpeg":
+            main["format"] = self.formats[self.pixel_format]
+
+        config = self.cam.create_video_configuration(
+            main = main,
+            controls = {
+                "FrameRate": Config.framerate,
+            },
+            #buffer_count = 3,
+            #queue = False,
+        )
+        self.cam.align_configuration(config)
+        self.cam.configure(config)
+
+        if self.pixel_format == "jpeg":
+            encoder = JpegEncoder(num_threads = Config.picamera2_threads)
+            self.cam.start_recording(encoder, encoded_output(output, encoder))
+        else:
+            self.cam.start()
+            super().start(output)
+
+    def stop(self):
+        super().stop()
+        try:
+            if self.pixel_format == "jpeg":
+                self.cam.stop_recording()
+            else:
+                self.cam.stop()
+        except:
+            pass
+
+
+class SyntheticSource(FrameSource):
+    """Paints a red and a green pillar sliding across a plain background.
+
+    A cycle of frames is rendered up front, so the source itself costs next
+    to nothing while the pipeline is being measured.
+    """
+
+    red = (40, 40, 200)
+    green = (130, 200, 40)
+    background = (150, 150, 150)
+
+    def __init__(self, rate = None, cycle = 120):
+        super().__init__(rate)
+        self.cycle = cycle
+        self.frames = []
+        self.layout = None
+        self.index = 0
+
+    def render(self, i):
+        width, height = Config.full_resolution
+        frame = np.full((height, width, 3), self.background, dtype = np.uint8)
+        phase = 2 * math.pi * i / self.cycle
+
+        pillar_width = max(width // 24, 2)
+        for color, offset in ((self.red, 0), (self.green, math.pi)):
+            center = int(width / 2 + width * 0.4 * math.sin(phase + offset))
+            left = center - pillar_width // 2
+            cv2.rectangle(frame, (left, height // 5), (left + pillar_width, height), color, -1)
+
+        return frame
+
+    def read(self):
+        layout = (Config.full_resolution, Config.pixel_format)
+        if self.layout != layout:
+            self.layout = layout
+            self.frames = [encode_frame(self.render(i)) for i in range(self.cycle)]
+            self.index = 0
+
+        buf = self.frames[self.index]
+        self.index = (self.index + 1) % self.cycle
+        return buf
+
+
+class ReplaySource(FrameSource):
+    """Replays recorded JPEG frames from a directory (or a glob pattern).
+
+    For raw pixel formats the recordings are decoded once, up front, and
+    replayed in the same layout the camera would deliver.
+    """
+
+    def __init__(self, path, rate = None, loop = True):
+        super().__init__(rate)
+        if os.path.isdir(path):
+            path = os.path.join(path, '*.jpg')
+        self.paths = sorted(glob.glob(path))
+        if len(self.paths) == 0:
+            raise FileNotFoundError(f"No frames found at \"{path}\"")
+        self.recorded = [open(p, 'rb').read() for p in self.paths]
+        self.frames = self.recorded
+        self.pixel_format = "jpeg"
+        self.loop = loop
+        self.index = 0
+
+    def convert(self, pixel_format):
+        if pixel_format == self.pixel_format:
+            return
+        self.pixel_format = pixel_format
+        if pixel_format == "jpeg":
+            self.frames = self.recorded
+        else:
+            self.frames = [
+                encode_frame(cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR), pixel_format)
+                for buf in self.recorded
+            ]
+
+    def read(self):
+        self.convert(Config.pixel_format)
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return None
+            self.index = 0
+
+        buf = self.frames[self.index]
+        self.index += 1
+        return buf
+
+
+class RecordingSource(FrameSource):
+    """Feeds the frames of a flight recording back into the pipeline.
+
+    Recorded strips are passed on as frames of their own, the bands are set
+    up to look at them as a whole.
+    """
+
+    def __init__(self, path, rate = None, loop = True):
+        super().__init__(rate)
+        from api.recorder import Recording, use_recorded_layout
+        recording = Recording(path)
+        self.frames = [image for seq, timestamp, top, image, detections in recording.frames() if image is not None]
+        recording.close()
+        if len(self.frames) == 0:
+            raise FileNotFoundError(f"No frames recorded in \"{path}\"")
+        use_recorded_layout(recording, self.frames[0])
+        self.loop = loop
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return None
+            self.index = 0
+
+        buf = self.frames[self.index]
+        self.index += 1
+        return buf
+
+
+def create_source(spec = None, rate = None):
+    if spec is None:
+        spec = Config.source
+    if rate is None:
+        rate = Config.source_rate
+
+    kind, _, arg = spec.partition(':')
+    if kind == "camera":
+        return CameraSource()
+    if kind == "synthetic":
+        return SyntheticSource(rate)
+    if kind == "replay":
+        return ReplaySource(arg, rate)
+    if kind == "recording":
+        return RecordingSource(arg, rate)
+    raise ValueError(f"Unknown frame source \"{spec}\"")
@@ -0,0 +1,112 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+
+class _Laps(threading.local):
+    prefix = ""
+    last = 0
+    # stage -> time of the laps since start() or enter(), None outside them
+    pending = None
+
+
+class StageTimer:
+    """Per-stage timings of the vision hot path.
+
+    Every lap() stores the time since the previous lap under the stage's
+    name. The last `size` samples of each stage are kept, percentiles are
+    only computed when somebody asks for them. When disabled, start(),
+    lap() and finish() return right away.
+
+    Laps are timed per thread, so work split over several threads can be
+    timed too: enter() makes the laps of the calling thread count from now
+    and go to "<prefix><stage>" until leave(), after which they count from
+    the leave() again. Between start() and finish(), or enter() and
+    leave(), laps of the same stage add up to a single sample, like the
+    windows searched while tracking.
+    """
+
+    def __init__(self, size = 300, enabled = True):
+        self.size = size
+        self.enabled = enabled
+        self.samples: dict[str, collections.deque] = {}
+        self.begin = 0
+        self.local = _Laps()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.begin = self.local.last = time.perf_counter()
+        self.local.prefix = ""
+        self.local.pending = {}
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        stage = self.local.prefix + stage
+        pending = self.local.pending
+        if pending is None:
+            self._add(stage, now - self.local.last)
+        else:
+            pending[stage] = pending.get(stage, 0) + now - self.local.last
+        self.local.last = now
+
+    def enter(self, prefix):
+        if not self.enabled:
+            return None
+        state = (self.local.prefix, self.local.pending)
+        self.local.prefix = prefix
+        self.local.pending = {}
+        self.local.last = time.perf_counter()
+        return state
+
+    def leave(self, state):
+        if state is None:
+            return
+        self._flush()
+        # the time in between went to the prefixed stages already
+        self.local.prefix, self.local.pending = state
+        self.local.last = time.perf_counter()
+
+    def _flush(self):
+        pending = self.local.pending
+        if pending is not None:
+            for stage, value in pending.items():
+                self._add(stage, value)
+        self.local.pending = None
+
+    def finish(self):
+        if not self.enabled:
+            return
+        self._flush()
+        self._add("total", time.perf_counter() - self.begin)
+
+    def _add(self, stage, value):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = collections.deque(maxlen = self.size)
+        samples.append(value)
+
+    def reset(self):
+        self.samples = {}
+
+    def summary(self):
+        result = {}
+        for stage, samples in list(self.samples.items()):
+            values = np.array(samples) * 1000
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, (50, 95, 99))
+            result[stage] = {
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "p99_ms": round(float(p99), 3),
+                "samples": len(values),
+            }
+        return result
+
+
+timer = StageTimer()
@@ -0,0 +1,95 @@
+from api.config import Config
+
+
+class Tracker:
+    """Narrows detection down to windows around the last detections.
+
+    Once something is found, the next frames only look at the columns of
+    each previous blob plus Config.tracking_margin on both sides; blobs
+    far apart get windows of their own, not one spanning the gap between
+    them. The whole strip is scanned again every Config.rescan_interval
+    frames and as soon as the windows come up empty.
+    """
+
+    def __init__(self):
+        # (left, right) columns of every blob found last
+        self.spans = []
+        self.since_scan = 0
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.tracked_frames = 0
+        self.full_scans = 0
+        self.lost = 0
+        self.columns_scanned = 0
+        self.columns_total = 0
+
+    def windows(self, width):
+        """Sorted, non-overlapping (left, right) column ranges to process next."""
+        if not Config.tracking or len(self.spans) == 0 or self.since_scan >= Config.rescan_interval:
+            return [(0, width)]
+        windows = []
+        for left, right in sorted(self.spans):
+            left, right = max(0, left - Config.tracking_margin), min(width, right + Config.tracking_margin)
+            if len(windows) > 0 and left <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], right))
+            else:
+                windows.append((left, right))
+        return windows
+
+    def update(self, blobs, windows, width):
+        """Takes the blobs (in strip coordinates) found in `windows`."""
+        full = windows == [(0, width)]
+        self.frames += 1
+        self.columns_scanned += sum(right - left for left, right in windows)
+        self.columns_total += width
+        if full:
+            self.full_scans += 1
+            self.since_scan = 0
+        else:
+            self.tracked_frames += 1
+            self.since_scan += 1
+
+        if len(blobs) == 0 and not full:
+            self.lost += 1
+        self.spans = [(blob.rect[0], blob.rect[0] + blob.rect[2]) for blob in blobs.values()]
+
+    def stats(self):
+        return {
+            "enabled": Config.tracking,
+            "windows": [list(span) for span in self.spans],
+            "frames": self.frames,
+            "tracked_frames": self.tracked_frames,
+            "full_scans": self.full_scans,
+            "lost": self.lost,
+            "columns_scanned_percent": round(self.columns_scanned / self.columns_total * 100, 2) if self.columns_total > 0 else None,
+        }
+
+
+class Trackers:
+    """One Tracker per band, see Config.bands."""
+
+    def __init__(self):
+        self.bands = {}
+
+    def get(self, band):
+        tracker = self.bands.get(band)
+        if tracker is None:
+            tracker = self.bands[band] = Tracker()
+        return tracker
+
+    def reset(self):
+        for tracker in list(self.bands.values()):
+            tracker.reset()
+
+    def forget(self):
+        # drops the windows along with the stats, like after the warm-up frame
+        self.bands.clear()
+
+    def stats(self):
+        # bands that were removed from the settings are left out
+        return {band: tracker.stats() for band, tracker in list(self.bands.items()) if band in Config.bands}
+
+
+trackers = Trackers()
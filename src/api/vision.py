@@ -0,0 +1,544 @@
+import base64
+import collections
+import concurrent.futures
+import functools
+import json
+import math
+import zlib
+
+import cv2
+import numpy as np
+
+from api.config import Config
+from api.timing import timer
+from api.classify import table, find_blobs, native, native_blobs, rank, Blob
+from api.tracking import trackers
+from api.recorder import recorder
+
+
+def preview_names():
+    # one mask preview per configured color class
+    return ("full",) + tuple(name + "_mask" for name in Config.color_ranges) + ("contours",)
+
+
+# downscale factors and JPEG quality used unless a client asks for others,
+# everything but the full frame is shown at quarter size
+default_scales = {
+    "full": 0.125,
+}
+default_quality = 95
+
+# one rendered version of a preview, shared by every client asking for it
+Rendition = collections.namedtuple("Rendition", ("name", "scale", "quality"))
+
+
+def rendition(name, scale = None, quality = None):
+    if scale is None:
+        scale = default_scales.get(name, 0.25)
+    if quality is None:
+        quality = default_quality
+    return Rendition(name, round(scale, 3), int(quality))
+
+
+def default_renditions():
+    return tuple(rendition(name) for name in preview_names())
+
+
+class Frame:
+    """Result of one process_frame call.
+
+    Published frames are shared by every subscriber, so they are frozen
+    before they leave the worker; only the base64 cache is filled later.
+    A preview that did not change is the JPEG of an earlier frame, its
+    version is the seq of the frame it was encoded in.
+    """
+
+    def __init__(self, seq = 0, timestamp = 0):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.previews = {}
+        self.versions = {}
+        self.detections = []
+        self.text = {}
+        self.frozen = False
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError("Frame is read-only once published")
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        self.frozen = True
+
+    def jpeg(self, rendition):
+        return self.previews.get(rendition)
+
+    def version(self, rendition):
+        return self.versions.get(rendition)
+
+    def base64(self, rendition):
+        # only text mode clients need this, encode once per frame and rendition
+        text = self.text.get(rendition)
+        if text is None:
+            jpeg = self.jpeg(rendition)
+            if jpeg is None:
+                return None
+            text = self.text[rendition] = base64.b64encode(jpeg).decode('utf-8')
+        return text
+
+    def record(self):
+        return {
+            "seq": self.seq,
+            "timestamp": self.timestamp,
+            "detections": self.detections,
+        }
+
+    def record_json(self):
+        # shared by every /detections client, serialized once per frame
+        text = self.text.get("record")
+        if text is None:
+            text = self.text["record"] = json.dumps(self.record(), separators = (',', ':'))
+        return text
+
+
+def frame_height(frame):
+    # I420 buffers stack the U and V planes under the Y plane
+    if frame.ndim == 2:
+        return frame.shape[0] * 2 // 3
+    return frame.shape[0]
+
+
+def to_bgr(frame):
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
+    return frame
+
+
+def cut_strip(frame, top, bottom):
+    if frame.ndim == 3:
+        return frame[top:bottom, :, :]
+
+    # convert only the rows of the strip: the Y rows plus the matching
+    # quarter-width rows of the U and V planes, repacked as a small I420 image;
+    # that takes an even first row and a multiple of 4 rows, so a few rows
+    # around the strip are converted too and cut off again afterwards
+    height = frame_height(frame)
+    width = frame.shape[1]
+    rows = min(-(-(bottom - top + top % 2) // 4) * 4, height - height % 4)
+    start = min(top - top % 2, height - rows)
+    start -= start % 2
+    end = start + rows
+    planes = frame[height:].reshape(2, height // 2, width // 2)
+    i420 = np.concatenate((
+        frame[start:end].reshape(-1),
+        planes[0, start // 2:end // 2].reshape(-1),
+        planes[1, start // 2:end // 2].reshape(-1),
+    )).reshape(-1, width)
+    return cv2.cvtColor(i420, cv2.COLOR_YUV2BGR_I420)[top - start:bottom - start]
+
+
+# one horizontal band of the frame that detection looks at
+Band = collections.namedtuple("Band", ("name", "center", "height"))
+
+
+def configured_bands():
+    return tuple(
+        Band(name, center, height if height is not None else Config.cut_frame_height)
+        for name, (center, height) in Config.bands.items()
+    )
+
+
+def band_rows(frame, band):
+    height = frame_height(frame)
+    top = int(height * band.center) - band.height // 2
+    top = min(max(top, 0), max(height - band.height, 0))
+    return top, top + band.height
+
+
+def read_frame(buf):
+    # raw buffers (BGR or I420 numpy arrays) skip the decode entirely
+    if isinstance(buf, np.ndarray):
+        frame = buf
+    else:
+        frame = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+    timer.lap("decode")
+    return frame
+
+
+def read_strip(buf):
+    """Returns the whole frame and the BGR strip of the first band."""
+    frame = read_frame(buf)
+    top, bottom = band_rows(frame, configured_bands()[0])
+    section = cut_strip(frame, top, bottom)
+    timer.lap("strip")
+    return frame, section, top
+
+
+@functools.lru_cache
+def thresholds(ranges):
+    # numpy bounds for cv2.inRange, built once per set of ranges
+    return [(np.array(lower), np.array(upper)) for lower, upper in ranges]
+
+
+def hsv_masks(section, classes):
+    """Reference path: blur the strip, convert it to HSV and threshold it."""
+    blurred = cv2.GaussianBlur(section, (3, 3), 0)
+    timer.lap("blur")
+
+    # H [0, 180], S [0, 255], V [0, 255]
+    hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+    timer.lap("hsv")
+
+    masks = {}
+    for name, ranges in classes.items():
+        mask = None
+        for lower, upper in thresholds(ranges):
+            part = cv2.inRange(hsv, lower, upper)
+            mask = part if mask is None else cv2.bitwise_or(mask, part)
+        masks[name] = mask
+        timer.lap(name + "_mask")
+    return blurred, masks
+
+
+@functools.lru_cache(maxsize = 4)
+def bearing_table(width, fov):
+    """Horizontal angle in degrees of every pixel column, 0 is straight ahead."""
+    focal = width / 2 / math.tan(math.radians(fov) / 2)
+    columns = np.arange(width) + 0.5 - width / 2
+    return np.degrees(np.arctan(columns / focal))
+
+
+def detections(blobs, top, width, band = None):
+    bearings = bearing_table(width, Config.fov)
+    result = []
+    for blob in blobs.values():
+        x, y, w, h = blob.rect
+        result.append({
+            "class": blob.name,
+            "band": band,
+            "bbox": [x, y + top, w, h],
+            "area": round(float(blob.area), 1),
+            "bearing": round(float(bearings[min(x + w // 2, width - 1)]), 2),
+        })
+    return result
+
+
+def contour_blobs(masks):
+    """Largest blob of every class, one findContours pass per mask."""
+    blobs = {}
+    for name, mask in masks.items():
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)
+        if len(contours) > 0:
+            largest_contour = max(contours, key=cv2.contourArea)
+            blobs[name] = Blob(name, cv2.boundingRect(largest_contour), cv2.contourArea(largest_contour))
+        timer.lap(name + "_contours")
+    return blobs
+
+
+def lut_labels(section, classes):
+    """Labels the strip through the lookup table in a single pass."""
+    table.update(tuple(classes.values()), Config.lut_bits)
+    labels = table.classify(section)
+    timer.lap("classify")
+    return labels
+
+
+def label_mask(labels, classes, name):
+    label = list(classes).index(name) + 1
+    return cv2.compare(labels, label, cv2.CMP_EQ)
+
+
+def lut_masks(section, classes):
+    labels = lut_labels(section, classes)
+    return section, {name: label_mask(labels, classes, name) for name in classes}
+
+
+class Scan:
+    """Everything detection found in one band, kept for the previews.
+
+    `windows` are the (left, right) columns that were searched, the whole
+    strip unless tracking narrowed it down; `views`, `bases`, `masks` and
+    `labels` hold one entry per window.
+    """
+
+    def __init__(self, band, section, top, windows):
+        self.band = band
+        self.section = section
+        self.top = top
+        self.windows = windows
+        self.views = [section[:, left:right] for left, right in windows]
+        self.tracking = windows != [(0, section.shape[1])]
+        self.bases = [None] * len(windows)
+        self.masks = [None] * len(windows)
+        self.labels = [None] * len(windows)
+        self.blobs = {}
+        self.detections = []
+
+
+def scan_band(frame, band, classes, prefix = ""):
+    """Cuts one band out of the frame and runs detection on it."""
+    state = timer.enter(prefix)
+    top, bottom = band_rows(frame, band)
+    section = cut_strip(frame, top, bottom)
+    timer.lap("strip")
+
+    # with tracking on, only windows around the last detections are searched
+    width = section.shape[1]
+    tracker = trackers.get(band.name)
+    scan = Scan(band, section, top, tracker.windows(width))
+
+    blobs = {}
+    for i, ((left, right), view) in enumerate(zip(scan.windows, scan.views)):
+        # the lut path segments every class at once: one lookup pass and one
+        # connected components pass, however many classes are configured; the
+        # native kernel fuses both into a single pass and falls back to the
+        # lut path when it was not built; the hsv path thresholds and
+        # contours each class separately
+        if Config.classifier == "native" and native is not None:
+            # classify, label and measure in one pass, without label or mask images
+            scan.bases[i] = view
+            found = native_blobs(view, tuple(classes))
+            timer.lap("blobs")
+        elif Config.classifier in ("lut", "native"):
+            scan.bases[i] = view
+            scan.labels[i] = lut_labels(view, classes)
+            found = find_blobs(scan.labels[i], tuple(classes))
+            timer.lap("blobs")
+        else:
+            scan.bases[i], scan.masks[i] = hsv_masks(view, classes)
+            found = contour_blobs(scan.masks[i])
+
+        # largest blob of every class over all windows, in strip columns
+        for name, blob in found.items():
+            if left > 0:
+                blob = blob._replace(rect = (blob.rect[0] + left,) + tuple(blob.rect[1:]))
+            if name not in blobs or rank(blob) < rank(blobs[name]):
+                blobs[name] = blob
+    tracker.update(blobs, scan.windows, width)
+
+    scan.blobs = blobs
+    scan.detections = detections(blobs, top, width, band.name)
+    timer.leave(state)
+    return scan
+
+
+band_pool = None
+band_workers = 0
+
+
+def scan_bands(frame, bands, classes):
+    """Scans every band, in parallel when there are several of them.
+
+    OpenCV and the native kernel release the GIL, so the bands really run
+    at the same time. The first band is scanned on the calling thread.
+    """
+    global band_pool, band_workers
+    if len(bands) == 1:
+        return [scan_band(frame, bands[0], classes)]
+
+    if band_workers < len(bands) - 1:
+        if band_pool is not None:
+            band_pool.shutdown(wait = False)
+        band_workers = len(bands) - 1
+        band_pool = concurrent.futures.ThreadPoolExecutor(max_workers = band_workers, thread_name_prefix = "band")
+
+    futures = [band_pool.submit(scan_band, frame, band, classes, band.name + "/") for band in bands[1:]]
+    scans = [scan_band(frame, bands[0], classes, bands[0].name + "/")]
+    scans.extend(future.result() for future in futures)
+    timer.lap("bands")
+    return scans
+
+
+def mask_preview(scan, classes, name):
+    masks = []
+    for i, view in enumerate(scan.views):
+        if scan.masks[i] is not None:
+            masks.append(scan.masks[i][name])
+            continue
+        if scan.labels[i] is None:
+            # the native path never builds the labels, only mask previews need them
+            scan.labels[i] = lut_labels(view, classes)
+        masks.append(label_mask(scan.labels[i], classes, name))
+    if not scan.tracking:
+        return masks[0]
+
+    # show the windows' masks in place on the whole strip
+    padded = np.zeros(scan.section.shape[:2], dtype = np.uint8)
+    for (left, right), mask in zip(scan.windows, masks):
+        padded[:, left:right] = mask
+    return padded
+
+
+def contour_preview(scan):
+    base = scan.bases[0]
+    # the lut path hands back the strip itself, which may be a view into
+    # a frame the source still owns; while tracking, draw on the whole strip
+    if base is scan.views[0] or scan.tracking:
+        base = scan.section.copy()
+    for blob in scan.blobs.values():
+        cv2.rectangle(base, blob.rect, (0, 255, 0), 1)
+    if scan.tracking:
+        for left, right in scan.windows:
+            cv2.rectangle(base, (left, 0), (right - 1, base.shape[0] - 1), (255, 0, 0), 1)
+    return base
+
+
+def stack(images):
+    # bands are shown one under the other, in the order they are configured
+    return images[0] if len(images) == 1 else np.vstack(images)
+
+
+# color previews are compared by a thumbnail this much smaller
+thumbnail_scale = 0.125
+
+
+def signature(image, extra = None):
+    """Something to tell whether a preview changed since it was last encoded.
+
+    Masks are hashed, color images shrunk to a thumbnail and compared with
+    some tolerance for sensor noise. `extra` is compared as is, like the
+    drawn rectangles.
+    """
+    if image.ndim == 2:
+        return extra, zlib.crc32(np.ascontiguousarray(image))
+    return extra, scaled(image, thumbnail_scale)
+
+
+def similar(a, b):
+    if a[0] != b[0]:
+        return False
+    if isinstance(a[1], int) or isinstance(b[1], int):
+        return a[1] == b[1]
+    if a[1].shape != b[1].shape:
+        return False
+    return cv2.norm(a[1], b[1], cv2.NORM_L1) / a[1].size <= Config.preview_change_threshold
+
+
+def scaled(image, scale):
+    # never down to nothing, strips may be only a few rows high
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(round(width * scale), 1), max(round(height * scale), 1)))
+
+
+class PreviewChanges:
+    """Remembers what every rendition looked like when it was last encoded."""
+
+    def __init__(self, size = 64):
+        self.size = size
+        # rendition -> (signature, seq, jpeg) of its last encode
+        self.last = {}
+        self.reset()
+
+    def reset(self):
+        # stream name -> [encoded, skipped]
+        self.counts = {}
+
+    def forget(self):
+        self.last.clear()
+        self.reset()
+
+    def unchanged(self, rendition, seq, signature):
+        """(jpeg, version) of `rendition` when it need not be encoded again in frame `seq`."""
+        counts = self.counts.setdefault(rendition.name, [0, 0])
+        last = self.last.get(rendition)
+        if last is not None and 0 <= seq - last[1] < Config.preview_keyframe and similar(last[0], signature):
+            counts[1] += 1
+            return last[2], last[1]
+        counts[0] += 1
+        return None
+
+    def encoded(self, rendition, seq, signature, jpeg):
+        self.last[rendition] = (signature, seq, jpeg)
+        if len(self.last) > self.size:
+            # clients may ask for any scale, forget the longest unused one
+            del self.last[min(self.last, key = lambda key: self.last[key][1])]
+
+    def stats(self):
+        return {
+            name: {
+                "encoded": encoded,
+                "skipped": skipped,
+                "skipped_percent": round(skipped / max(encoded + skipped, 1) * 100, 2),
+            }
+            for name, (encoded, skipped) in list(self.counts.items())
+        }
+
+
+preview_changes = PreviewChanges()
+
+
+def process_frame(buf, renditions = None, seq = 0, timestamp = 0, record = True):
+    """Runs detection on one frame and renders the requested previews."""
+    result = Frame(seq, timestamp)
+    if renditions is None:
+        renditions = default_renditions()
+    timer.start()
+
+    # /settings may replace the classes or bands while we are working on this frame
+    classes = Config.color_ranges
+    bands = configured_bands()
+    if Config.classifier in ("lut", "native"):
+        # built before the bands are scanned, never by two of them at once
+        table.update(tuple(classes.values()), Config.lut_bits)
+    frame = read_frame(buf)
+
+    scans = scan_bands(frame, bands, classes)
+    for scan in scans:
+        result.detections.extend(scan.detections)
+
+    if record and recorder.map is not None:
+        section = stack([scan.section for scan in scans])
+        recorder.record(seq, timestamp, frame, section, scans[0].top, result.detections)
+        timer.lap("record")
+
+    # previews are only rendered for streams somebody is watching
+    if len(renditions) == 0:
+        timer.finish()
+        return result
+
+    names = set(rendition.name for rendition in renditions)
+    images = {}
+    if "full" in names:
+        images["full"] = to_bgr(frame)
+    for name in classes:
+        if name + "_mask" in names:
+            images[name + "_mask"] = stack([mask_preview(scan, classes, name) for scan in scans])
+    if "contours" in names:
+        images["contours"] = stack([contour_preview(scan) for scan in scans])
+
+    # unchanged previews are not encoded again, the frame carries the JPEG
+    # of their last encode and subscribers only send clients what is new
+    signatures = {}
+    if Config.preview_keyframe > 0:
+        for name, image in images.items():
+            extra = None
+            if name == "contours":
+                extra = tuple((tuple(scan.windows), tuple(blob.rect for blob in scan.blobs.values())) for scan in scans)
+            signatures[name] = signature(image, extra)
+        timer.lap("changes")
+
+    small = {}
+    for rendition in renditions:
+        # a client may still ask for the mask of a class that was removed
+        if rendition.name not in images:
+            continue
+        known = signatures.get(rendition.name)
+        if known is not None:
+            cached = preview_changes.unchanged(rendition, seq, known)
+            if cached is not None:
+                result.previews[rendition], result.versions[rendition] = cached
+                continue
+        small[rendition] = scaled(images[rendition.name], rendition.scale)
+    timer.lap("resize")
+
+    for rendition, image in small.items():
+        params = (cv2.IMWRITE_JPEG_QUALITY, rendition.quality)
+        jpeg = result.previews[rendition] = cv2.imencode('.jpg', image, params)[1].tobytes()
+        result.versions[rendition] = seq
+        known = signatures.get(rendition.name)
+        if known is not None:
+            preview_changes.encoded(rendition, seq, known, jpeg)
+    timer.lap("encode")
+    timer.finish()
+
+    return result
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+
+class Mailbox:
+    """Single-slot, latest-wins handoff between threads.
+
+    put() never blocks: a newer item replaces the one still waiting, and
+    the replaced item is counted as dropped.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.received += 1
+            self.condition.notify()
+
+    def get(self):
+        # returns None once the mailbox is closed
+        with self.condition:
+            while self.item is None and not self.closed:
+                self.condition.wait()
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reset(self):
+        with self.condition:
+            self.received = 0
+            self.dropped = 0
+
+
+class FrameWorker(threading.Thread):
+    """Runs `process` on the latest item of a mailbox, off the event loop.
+
+    `prepare` runs first, items arriving meanwhile wait in the mailbox.
+    """
+
+    def __init__(self, mailbox, process, prepare = None):
+        super().__init__(name = "frame-worker", daemon = True)
+        self.mailbox = mailbox
+        self.process = process
+        self.prepare = prepare
+
+    def run(self):
+        if self.prepare is not None:
+            try:
+                self.prepare()
+            except Exception:
+                logging.exception("Preparing the worker failed")
+        while True:
+            item = self.mailbox.get()
+            if item is None:
+                break
+            try:
+                self.process(item)
+            except Exception:
+                logging.exception("Processing frame failed")
+
+    def stop(self):
+        self.mailbox.close()
+        self.join()
@@ -2,3 +2,5 @@ import { writable } from 'svelte/store';
 
 export const api_url = writable('http://pi.local:8000');
 export const ws_url = writable('ws://pi.local:8000');
+// names of the configured color classes, each has a "<name>_mask" stream
+export const color_classes = writable([]);
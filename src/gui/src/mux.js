@@ -0,0 +1,108 @@
+import { readable, get } from 'svelte/store';
+import { ws_url } from './globals.js';
+
+// One WebSocket to /ws carries every preview, the detections and the stats,
+// see multiplexed() in api/main.py for the message layout.
+const batch_header_size = 13;
+const part_header_size = 5;
+const decoder = new TextDecoder();
+
+let socket = null;
+// channel name -> { options, listeners }
+const channels = new Map();
+
+function send (message) {
+    if (socket !== null && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify(message));
+    }
+}
+
+function dispatch (data) {
+    const view = new DataView(data);
+    const seq = view.getUint32(0, true);
+    const timestamp = view.getFloat64(4, true);
+    const count = view.getUint8(12);
+
+    let offset = batch_header_size;
+    for (let i = 0; i < count; i++) {
+        const name_size = view.getUint8(offset);
+        const payload_size = view.getUint32(offset + 1, true);
+        offset += part_header_size;
+        const name = decoder.decode(new Uint8Array(data, offset, name_size));
+        offset += name_size;
+        const payload = new Uint8Array(data, offset, payload_size);
+        offset += payload_size;
+
+        const channel = channels.get(name);
+        if (channel !== undefined) {
+            for (const listener of channel.listeners) {
+                listener({ seq, timestamp, payload });
+            }
+        }
+    }
+}
+
+function connect () {
+    if (socket !== null) {
+        socket.onclose = null;
+        socket.close();
+    }
+    socket = new WebSocket(get(ws_url) + '/ws');
+    socket.binaryType = 'arraybuffer';
+
+    socket.onopen = () => {
+        for (const [name, channel] of channels) {
+            send({ subscribe: name, ...channel.options });
+        }
+    };
+    socket.onmessage = event => {
+        if (typeof event.data === 'string') {
+            console.warn(JSON.parse(event.data).error);
+        } else {
+            dispatch(event.data);
+        }
+    };
+    socket.onclose = () => {
+        setTimeout(connect, 1000);
+    };
+}
+
+ws_url.subscribe(() => {
+    if (socket !== null) {
+        connect();
+    }
+});
+
+// Store of the latest { seq, timestamp, payload } of a channel: "full",
+// "<class>_mask", "contours", "detections" or "stats". Options are sent
+// along with the subscription, like { scale, quality } or { interval }.
+export function channel (name, options = {}) {
+    return readable(null, set => {
+        // nothing to connect to while rendering on the server
+        if (typeof WebSocket === 'undefined') {
+            return;
+        }
+        if (socket === null) {
+            connect();
+        }
+        let entry = channels.get(name);
+        if (entry === undefined) {
+            entry = { options, listeners: new Set() };
+            channels.set(name, entry);
+            send({ subscribe: name, ...options });
+        }
+        entry.listeners.add(set);
+
+        return () => {
+            entry.listeners.delete(set);
+            if (entry.listeners.size === 0) {
+                channels.delete(name);
+                send({ unsubscribe: name });
+            }
+        };
+    });
+}
+
+export function json (payload) {
+    return JSON.parse(decoder.decode(payload));
+}
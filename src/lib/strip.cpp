@@ -0,0 +1,166 @@
+#include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
+
+#include <algorithm>
+#include <cstdint>
+#include <stdexcept>
+#include <tuple>
+#include <vector>
+
+namespace py = pybind11;
+
+namespace {
+
+// horizontal run of pixels of one class in one row, end is exclusive
+struct Run {
+    int start;
+    int end;
+    uint8_t label;
+    int node;
+};
+
+// union-find node carrying the bounding box and area of its component,
+// right and bottom are exclusive
+struct Node {
+    int parent;
+    int left;
+    int right;
+    int top;
+    int bottom;
+    int64_t area;
+    uint8_t label;
+};
+
+int find_root(std::vector<Node>& nodes, int i) {
+    while (nodes[i].parent != i) {
+        nodes[i].parent = nodes[nodes[i].parent].parent;
+        i = nodes[i].parent;
+    }
+    return i;
+}
+
+void unite(std::vector<Node>& nodes, int a, int b) {
+    a = find_root(nodes, a);
+    b = find_root(nodes, b);
+    if (a == b) {
+        return;
+    }
+    if (b < a) {
+        std::swap(a, b);
+    }
+    Node& root = nodes[a];
+    const Node& other = nodes[b];
+    root.left = std::min(root.left, other.left);
+    root.right = std::max(root.right, other.right);
+    root.top = std::min(root.top, other.top);
+    root.bottom = std::max(root.bottom, other.bottom);
+    root.area += other.area;
+    nodes[b].parent = a;
+}
+
+// the largest blob wins, equally large ones go to the topmost, then
+// leftmost box, like rank() in api/classify.py
+bool ranks_before(const Node& a, const Node& b) {
+    return std::make_tuple(-a.area, a.top, a.left, a.right - a.left, a.bottom - a.top)
+        < std::make_tuple(-b.area, b.top, b.left, b.right - b.left, b.bottom - b.top);
+}
+
+}  // namespace
+
+// Classifies every pixel of a BGR strip through the lookup table built by
+// api/classify.py and returns the largest 8-connected blob of every class
+// as (x, y, w, h, area), or None. Classification, labeling and the bounding
+// boxes are done in a single pass over the strip, without any mask images.
+py::list find_blobs(py::array_t<uint8_t> strip, py::array_t<uint8_t> table, int bits, int classes) {
+    if (strip.ndim() != 3 || strip.shape(2) != 3) {
+        throw std::invalid_argument("strip must be a BGR image");
+    }
+    if (bits < 1 || bits > 8 || table.ndim() != 1 || table.shape(0) != (py::ssize_t(1) << (3 * bits))) {
+        throw std::invalid_argument("table does not match bits");
+    }
+    if (classes < 1 || classes > 254) {
+        throw std::invalid_argument("classes must be between 1 and 254");
+    }
+
+    const auto pixels = strip.unchecked<3>();
+    const auto lut = table.unchecked<1>();
+    const int height = static_cast<int>(strip.shape(0));
+    const int width = static_cast<int>(strip.shape(1));
+    const int shift = 8 - bits;
+
+    std::vector<Node> nodes;
+    std::vector<Run> previous;
+    std::vector<Run> current;
+    std::vector<int> best(classes + 1, -1);
+
+    {
+        py::gil_scoped_release release;
+
+        for (int y = 0; y < height; y++) {
+            current.clear();
+
+            uint8_t label = 0;
+            int start = 0;
+            for (int x = 0; x <= width; x++) {
+                uint8_t value = 0;
+                if (x < width) {
+                    const uint32_t b = pixels(y, x, 0) >> shift;
+                    const uint32_t g = pixels(y, x, 1) >> shift;
+                    const uint32_t r = pixels(y, x, 2) >> shift;
+                    value = lut((b << (2 * bits)) | (g << bits) | r);
+                }
+                if (value != label) {
+                    if (label != 0) {
+                        current.push_back(Run{start, x, label, -1});
+                    }
+                    label = value;
+                    start = x;
+                }
+            }
+
+            // runs of the previous row touching this run, diagonals included
+            size_t first = 0;
+            for (Run& run : current) {
+                run.node = static_cast<int>(nodes.size());
+                nodes.push_back(Node{run.node, run.start, run.end, y, y + 1, run.end - run.start, run.label});
+
+                while (first < previous.size() && previous[first].end < run.start) {
+                    first++;
+                }
+                for (size_t k = first; k < previous.size() && previous[k].start <= run.end; k++) {
+                    if (previous[k].label == run.label) {
+                        unite(nodes, previous[k].node, run.node);
+                    }
+                }
+            }
+
+            std::swap(previous, current);
+        }
+
+        for (size_t i = 0; i < nodes.size(); i++) {
+            const Node& node = nodes[i];
+            if (node.parent != static_cast<int>(i) || node.label > classes) {
+                continue;
+            }
+            if (best[node.label] < 0 || ranks_before(node, nodes[best[node.label]])) {
+                best[node.label] = static_cast<int>(i);
+            }
+        }
+    }
+
+    py::list result;
+    for (int label = 1; label <= classes; label++) {
+        if (best[label] < 0) {
+            result.append(py::none());
+            continue;
+        }
+        const Node& node = nodes[best[label]];
+        result.append(py::make_tuple(node.left, node.top, node.right - node.left, node.bottom - node.top, node.area));
+    }
+    return result;
+}
+
+PYBIND11_MODULE(main, m) {
+    m.doc() = "Native kernels of the vision pipeline";
+    m.def("find_blobs", &find_blobs, py::arg("strip"), py::arg("table"), py::arg("bits"), py::arg("classes"));
+}
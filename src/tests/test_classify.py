@@ -0,0 +1,69 @@
+"""Blobs of the lut path and of the native kernel, run from the src directory:
+
+    make native
+    python -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+from api.classify import table, find_blobs, native, native_blobs
+from api.config import Config
+
+
+names = tuple(Config.color_ranges)
+red = (0, 0, 255)
+green = (170, 255, 0)
+background = (40, 40, 40)
+
+
+@pytest.fixture(autouse = True)
+def lookup_table():
+    table.update(tuple(Config.color_ranges.values()), Config.lut_bits)
+
+
+def strip(*boxes, height = 40, width = 1536):
+    image = np.full((height, width, 3), background, dtype = np.uint8)
+    for color, (x, y, w, h) in boxes:
+        image[y:y + h, x:x + w] = color
+    return image
+
+
+def noise(seed, count = 200):
+    """Strips of one and two pixel specks, many of them equally large."""
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        boxes = []
+        for _ in range(rng.integers(1, 60)):
+            color = (red, green)[rng.integers(0, 2)]
+            boxes.append((color, (int(rng.integers(0, 1535)), int(rng.integers(0, 39)), int(rng.integers(1, 3)), int(rng.integers(1, 3)))))
+        if rng.integers(0, 4) == 0:
+            # a pillar, with a speck of the other class touching it
+            x = int(rng.integers(0, 1500))
+            boxes.append((red, (x, 0, 20, 40)))
+            boxes.append((green, (x + 20, 10, 2, 2)))
+        yield strip(*boxes)
+
+
+def test_ties_go_to_the_topmost_then_leftmost_blob():
+    image = strip(
+        (red, (100, 20, 4, 4)), (red, (50, 20, 4, 4)), (red, (300, 5, 4, 4)),
+        (green, (700, 12, 3, 3)), (green, (600, 12, 3, 3)),
+    )
+    blobs = find_blobs(table.classify(image), names)
+    assert blobs["red"].rect == (300, 5, 4, 4)
+    assert blobs["green"].rect == (600, 12, 3, 3)
+
+
+def test_ties_inside_touching_blobs_of_different_classes():
+    # one component holding both classes is split again inside its box
+    image = strip((red, (200, 10, 3, 3)), (green, (203, 10, 3, 3)), (green, (210, 2, 3, 3)))
+    blobs = find_blobs(table.classify(image), names)
+    assert blobs["green"].rect == (210, 2, 3, 3)
+
+
+@pytest.mark.skipif(native is None, reason = "native kernel not built")
+@pytest.mark.parametrize("seed", range(3))
+def test_native_matches_lut(seed):
+    for image in noise(seed):
+        assert native_blobs(image, names) == find_blobs(table.classify(image), names)